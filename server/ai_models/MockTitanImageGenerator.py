@@ -1,8 +1,8 @@
 from botocore.exceptions import ClientError, NoCredentialsError, BotoCoreError 
 from utils.error_check import handle_boto3_error
 from inspect import currentframe, getframeinfo
-from aws_utils import generate_presigned_url
-from botocore.client import Config
+from aws_utils import generate_presigned_url, uploadImageBytes
+from utils.image_payload import ImagePayload
 from fastapi import HTTPException
 from datetime import datetime
 from random import random
@@ -11,8 +11,6 @@ import traceback
 import botocore
 import asyncio
 import logging
-import base64
-import boto3
 import json
 import uuid
 import os
@@ -48,31 +46,17 @@ class MockTitanImageGenerator:
             image.save(buffered, format="JPEG")
             image_bytes = buffered.getvalue()
         
-        return base64.b64encode(image_bytes).decode('utf-8')
+        return ImagePayload(image_bytes)
 
-    def processAndSaveImage(self, image_data: str, img_id: str, s3_bucket_name: str):
+    def processAndSaveImage(self, image: ImagePayload, img_id: str, s3_bucket_name: str):
         try:
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-
-            buffered = io.BytesIO()
-            image.save(buffered, format="JPEG", quality=85)
-            compressed_image_bytes = buffered.getvalue()
-            s3_client = boto3.client(
-                "s3", region_name="us-east-2", config=Config(signature_version="s3v4")
-            )
-
-            image_key = f"{img_id}.jpg"
-            s3_client.upload_fileobj(
-                io.BytesIO(compressed_image_bytes),
-                s3_bucket_name,
-                image_key,
-                ExtraArgs={
-                    "ACL": "public-read",
-                    "ContentType": "image/jpeg",
-                    "ContentDisposition": "inline",
-                },
-            )
+            # JPEG payloads are uploaded as they are; anything else is converted once
+            if image.is_jpeg:
+                uploadImageBytes(bytes(image), img_id, s3_bucket_name)
+            else:
+                buffered = io.BytesIO()
+                image.open().convert("RGB").save(buffered, format="JPEG", quality=85)
+                uploadImageBytes(buffered.getvalue(), img_id, s3_bucket_name)
 
             return img_id
         except NoCredentialsError:
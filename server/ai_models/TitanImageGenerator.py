@@ -1,17 +1,15 @@
 from botocore.exceptions import ClientError, NoCredentialsError, BotoCoreError 
 from utils.error_check import handle_boto3_error
 from inspect import currentframe, getframeinfo
-from aws_utils import generate_presigned_url
-from botocore.client import Config
+from aws_utils import generate_presigned_url, uploadImageBytes
+from utils.image_payload import ImagePayload
 from fastapi import HTTPException
 from datetime import datetime
 from random import random
-from PIL import Image
 import traceback
 import botocore
 import asyncio
 import logging
-import base64
 import boto3
 import json
 import uuid
@@ -48,12 +46,11 @@ class TitanImageGenerator:
 			loop = asyncio.get_event_loop()
 			response = await loop.run_in_executor(None, self.invoke_model_with_args,bedrock, byte_body, accept, content_type)
 			response_body = json.loads(response.get("body").read())
-			base64_image = response_body.get("images")[0]            
-			base64_bytes = base64_image.encode('ascii')
-			image_bytes = base64.b64decode(base64_bytes)
+			# Bedrock answers with base64 in JSON; from here on the image stays bytes
+			image = ImagePayload.from_base64(response_body.get("images")[0], "image/png")
 			duration = datetime.now() - start
 			img_id = str(uuid.uuid4())
-			img_url = self.processAndSaveImage(base64.b64encode(image_bytes).decode('utf-8'), img_id, "browse-image-v2")
+			img_url = await asyncio.to_thread(self.processAndSaveImage, image, img_id, "browse-image-v2")
 			return idx, img_id, prompt, 'titan'
 		except ClientError as e:
 			duration = datetime.now() - start
@@ -91,10 +88,9 @@ class TitanImageGenerator:
 			loop = asyncio.get_event_loop()
 			response = await loop.run_in_executor(None, self.invoke_model_with_args,bedrock, byte_body, accept, content_type)
 			response_body = json.loads(response.get("body").read())
-			base64_image = response_body.get("images")[0]            
-			base64_bytes = base64_image.encode('ascii')
-			image_bytes = base64.b64decode(base64_bytes)
-			base64_url = f"data:image/jpeg;base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+			base64_image = response_body.get("images")[0]
+			# Returned to the client as is, no need to decode and re-encode it
+			base64_url = f"data:image/jpeg;base64,{base64_image}"
 			return idx, base64_url, prompt, 'titan'
 		except ClientError as e:
 			duration = datetime.now() - start
@@ -114,29 +110,15 @@ class TitanImageGenerator:
 			contentType=content_type
 		)
 
-	def processAndSaveImage(self, image_data: str, img_id: str, s3_bucket_name: str):
+	def processAndSaveImage(self, image: ImagePayload, img_id: str, s3_bucket_name: str):
 		try:
-			image_bytes = base64.b64decode(image_data)
-			image = Image.open(io.BytesIO(image_bytes))
-
-			buffered = io.BytesIO()
-			image.save(buffered, format="JPEG", quality=85)
-			compressed_image_bytes = buffered.getvalue()
-			s3_client = boto3.client(
-				"s3", region_name="us-east-2", config=Config(signature_version="s3v4")
-			)
-
-			image_key = f"{img_id}.jpg"
-			s3_client.upload_fileobj(
-				io.BytesIO(compressed_image_bytes),
-				s3_bucket_name,
-				image_key,
-				ExtraArgs={
-	                "ACL": "public-read",
-	                "ContentType": "image/jpeg",
-	                "ContentDisposition": "inline",
-	            },
-			)
+			# JPEG payloads are uploaded as they are; anything else is converted once
+			if image.is_jpeg:
+				uploadImageBytes(bytes(image), img_id, s3_bucket_name)
+			else:
+				buffered = io.BytesIO()
+				image.open().convert("RGB").save(buffered, format="JPEG", quality=85)
+				uploadImageBytes(buffered.getvalue(), img_id, s3_bucket_name)
 
 			# url = generate_presigned_url(img_id, s3_bucket_name)
 			# return url
@@ -1,4 +1,5 @@
-import base64
+from utils.image_payload import ImagePayload
+from typing import Union
 from http.client import HTTPException
 import traceback
 from inspect import currentframe, getframeinfo
@@ -30,17 +31,56 @@ def generate_presigned_url(object_name, bucket_name, expiration=3600):
     return response
 
 
-def processAndSaveImage(image_data: str, img_id: str, s3_bucket_name: str):
+def uploadImageBytes(image_bytes: bytes, img_id: str, s3_bucket_name: str):
+    # Uploads an already encoded JPEG under the same key processAndSaveImage uses
+    s3_client = boto3.client(
+        "s3", region_name="us-east-2", config=Config(signature_version="s3v4")
+    )
+    image_key = f"{img_id}.jpg"
+    s3_client.upload_fileobj(
+        io.BytesIO(image_bytes),
+        s3_bucket_name,
+        image_key,
+        ExtraArgs={
+            "ACL": "public-read",
+            "ContentType": "image/jpeg",
+            "ContentDisposition": "inline",
+        },
+    )
+
+
+def uploadArtifactFile(file_path: str, key: str, s3_bucket_name: str, content_type: str):
+    # Private upload of a generated file (download archives); fetched through generate_artifact_url
+    s3_client = boto3.client(
+        "s3", region_name="us-east-2", config=Config(signature_version="s3v4")
+    )
+    s3_client.upload_file(file_path, s3_bucket_name, key, ExtraArgs={"ContentType": content_type})
+
+
+def generate_artifact_url(key: str, bucket_name: str, filename: str, expiration=3600):
+    # Unlike generate_presigned_url the key is used as is and the browser saves it as filename
+    s3_client = boto3.client(
+        "s3", region_name="us-east-2", config=Config(signature_version="s3v4")
+    )
     try:
-        # Split base64 data
-        if "," in image_data:
-            image_data = image_data.split(",", 1)[1]
-        else:
-            raise ValueError("Invalid image data")
+        return s3_client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": bucket_name,
+                "Key": key,
+                "ResponseContentDisposition": f'attachment; filename="{filename}"',
+            },
+            ExpiresIn=expiration,
+        )
+    except ClientError as e:
+        logging.error(e)
+        return None
 
-        # Decode the image
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
+
+def processAndSaveImage(image_data: Union[ImagePayload, str], img_id: str, s3_bucket_name: str):
+    try:
+        # Data URLs from request bodies are decoded once here; payloads are used as is
+        image = ImagePayload.coerce(image_data).open()
 
         # Handle different image modes
         if image.mode == "RGBA":
@@ -71,23 +111,7 @@ def processAndSaveImage(image_data: str, img_id: str, s3_bucket_name: str):
         image.save(buffered, format="JPEG", quality=85)
         compressed_image_bytes = buffered.getvalue()
 
-        # S3 client setup
-        s3_client = boto3.client(
-            "s3", region_name="us-east-2", config=Config(signature_version="s3v4")
-        )
-        image_key = f"{img_id}.jpg"
-
-        # Upload the image to S3
-        s3_client.upload_fileobj(
-            io.BytesIO(compressed_image_bytes),
-            s3_bucket_name,
-            image_key,
-            ExtraArgs={
-                "ACL": "public-read",
-                "ContentType": "image/jpeg",
-                "ContentDisposition": "inline",
-            },
-        )
+        uploadImageBytes(compressed_image_bytes, img_id, s3_bucket_name)
         return True
     except Exception as error:
         logger.error(f"Error in processAndSaveImage: {error}")
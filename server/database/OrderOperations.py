@@ -85,6 +85,22 @@ class OrderOperations(BaseDatabaseOperation):
             logger.critical(f"Error in updating order: {e}")
             return False
 
+    async def clear_thumbnails(self, thumbnail_ids: list) -> int:
+        # Items whose cart thumbnail never reached S3 go back to 'null', which
+        # readers check before presigning
+        if not thumbnail_ids:
+            return 0
+        try:
+            result = await self.db.orders.update_many(
+                {"item.thumbnail": {"$in": thumbnail_ids}},
+                {"$set": {"item.$[failed].thumbnail": "null"}},
+                array_filters=[{"failed.thumbnail": {"$in": thumbnail_ids}}],
+            )
+            return result.modified_count
+        except Exception as e:
+            logger.critical(f"Error clearing thumbnails: {e}")
+            return 0
+
     async def get_toggled_url(self, order_id: str) -> list:
         try:
             pipeline = [
@@ -1,16 +1,48 @@
+import time
+from datetime import datetime, timezone
 import logging
 from aws_utils import generate_presigned_url
 from database.BASE import BaseDatabaseOperation
 from models import OrganizationModel
+from utils.etag import compute_etag
+from utils.org_assets import find_inline_assets, slim_organization_stages
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+ORG_SUMMARY_PROJECTION = {'_id': 0, 'org_id': 1, 'name': 1, 'theme_color': 1, 'font': 1, 'updated_at': 1}
+ORG_VERSION_PROJECTION = {'_id': 0, 'org_id': 1, 'updated_at': 1}
+
+# Presigned URLs expire after an hour (generate_presigned_url default), so
+# ETags for signed payloads roll over every half hour to stop clients from
+# revalidating into expired links.
+SIGNED_URL_ETAG_WINDOW = 1800
+
+
+def signed_url_window():
+    return int(time.time() // SIGNED_URL_ETAG_WINDOW)
+
+
+def stamp_updated_at(org_data):
+    # List/detail ETags are derived from updated_at, so every write must move it
+    org_data['updated_at'] = datetime.now(timezone.utc).isoformat()
+    return org_data
+
+
+def list_etag(orgs, summary: bool = False):
+    versions = sorted((org.get('org_id'), org.get('updated_at')) for org in orgs)
+    return compute_etag({'summary': summary, 'versions': versions, 'window': None if summary else signed_url_window()})
+
+
+def detail_etag(org):
+    return compute_etag({'org_id': org.get('org_id'), 'updated_at': org.get('updated_at'), 'window': signed_url_window()})
+
 
 class OrganizationOperation(BaseDatabaseOperation):
     async def create(self, org_info: OrganizationModel) -> bool:
         try:
-            org_data = org_info.model_dump()
+            org_data = stamp_updated_at(org_info.model_dump())
+            self.ensure_no_inline_assets(org_data)
             result = await self.db.organizations.insert_one(org_data)
             return result.inserted_id is not None
         except Exception as e:
@@ -22,8 +54,9 @@ class OrganizationOperation(BaseDatabaseOperation):
 
     async def update(self, org_info: OrganizationModel) -> bool:
         try:
-            org_data = org_info.model_dump()
+            org_data = stamp_updated_at(org_info.model_dump())
             org_id = org_info.org_id
+            self.ensure_no_inline_assets(org_data)
 
             result = await self.db.organizations.update_one(
                 {"org_id": org_id},
@@ -34,71 +67,120 @@ class OrganizationOperation(BaseDatabaseOperation):
             logger.critical(f"Error in updating organization: {e}")
             return False
 
-    async def get(self):
+    async def get(self, summary: bool = False):
+        result, _ = await self.get_with_etag(summary)
+        return result
+
+    async def get_with_etag(self, summary: bool = False):
+        # The ETag is computed from the documents returned, so it always
+        # describes this response even if a write lands in between
         try:
-            s3_bucket = 'drophouse-skeleton'
-            org_data = await self.db.organizations.find({}, {'_id': 0}).to_list(length=None)
-            if org_data:
-                org_dict = {}
-                for org in org_data:
-                    if 'mask' in org and org['mask'] != None and org['mask'] != 'null' and org['mask'] != '':
-                        org['mask_id'] = org['mask']
-                        org['mask'] = generate_presigned_url(org['mask'], s3_bucket)
-                    if 'logo' in org and org['logo'] != None and org['logo'] != 'null' and org['logo'] != '':
-                        org['logo_id'] = org['logo']
-                        org['logo'] = generate_presigned_url(org['logo'], s3_bucket)
-                    if 'greenmask' in org and org['greenmask'] != None and org['greenmask'] != 'null' and org['greenmask'] != '':
-                        org['greenmask_id'] = org['greenmask']
-                        org['greenmask'] = generate_presigned_url(org['greenmask'], s3_bucket)
-                    if 'favicon' in org and org['favicon'] != None and org['favicon'] != 'null' and org['favicon'] != '':
-                        org['favicon_id'] = org['favicon']
-                        org['favicon'] = generate_presigned_url(org['favicon'], s3_bucket)
-
-                    for products in org['landingpage']:
-                        if 'asset' in products and products['asset'] != None and products['asset'] != 'null' and products['asset'] != '':
-                            products['asset_id'] = products['asset']
-                            products['asset'] = generate_presigned_url(products['asset'], s3_bucket)
-                        if 'asset_back' in products and products['asset_back'] != None and products['asset_back'] != 'null' and products['asset_back'] != '':
-                            products['asset_back_id'] = products['asset_back']
-                            products['asset_back'] = generate_presigned_url(products['asset_back'], s3_bucket)
-
-                    for product in org['products']:
-                        if 'mask' in product and product['mask'] != None and product['mask'] != 'null' and product['mask'] != '':
-                            product['mask_id'] = product['mask']
-                            product['mask'] = generate_presigned_url(product['mask'], s3_bucket)
-                        if 'greenmask' in product and product['greenmask'] != None and product['greenmask'] != 'null' and product['greenmask'] != '':
-                            product['greenmask_id'] = product['greenmask']
-                            product['greenmask'] = generate_presigned_url(product['greenmask'], s3_bucket)
-                        if 'defaultProduct' in product and product['defaultProduct'] != None and product['defaultProduct'] != 'null' and product['defaultProduct'] != '':
-                            product['defaultProduct_id'] = product['defaultProduct']
-                            product['defaultProduct'] = generate_presigned_url(product['defaultProduct'], s3_bucket)
-
-                        for color in product['colors']:
-                            if product['colors'][color]['asset']['front'] != None and product['colors'][color]['asset']['front'] != 'null' and product['colors'][color]['asset']['front'] != '':
-                                product['colors'][color]['asset']['front_id'] = product['colors'][color]['asset']['front']
-                                product['colors'][color]['asset']['front'] = generate_presigned_url(product['colors'][color]['asset']['front'], s3_bucket)
-                            if product['colors'][color]['asset']['back'] != None and product['colors'][color]['asset']['back'] != 'null' and product['colors'][color]['asset']['back'] != '':
-                                product['colors'][color]['asset']['back_id'] = product['colors'][color]['asset']['back']
-                                product['colors'][color]['asset']['back'] = generate_presigned_url(product['colors'][color]['asset']['back'], s3_bucket)
-
-                    org_dict[org['org_id']] = org
-                return org_dict
-            else:
-                return {}
+            if summary:
+                org_data = await self.db.organizations.find({}, ORG_SUMMARY_PROJECTION).to_list(length=None)
+                return {org['org_id']: org for org in org_data}, list_etag(org_data, summary)
+
+            org_data = await self.find_slim({})
+            etag = list_etag(org_data, summary)
+            org_dict = {}
+            for org in org_data:
+                org_dict[org['org_id']] = self.sign_organization_assets(org)
+            return org_dict, etag
         except Exception as e:
             logger.error(f"Error retrieving organizations: {e}")
-            return []
+            return [], None
+
+    async def get_detail(self, org_id: str):
+        org, _ = await self.get_detail_with_etag(org_id)
+        return org
+
+    async def get_detail_with_etag(self, org_id: str):
+        try:
+            org = await self.find_one_slim({"org_id": org_id})
+            if not org:
+                return None, None
+            return self.sign_organization_assets(org), detail_etag(org)
+        except Exception as e:
+            logger.error(f"Error retrieving organization detail with ID {org_id}: {e}")
+            return None, None
+
+    async def get_list_etag(self, summary: bool = False):
+        # Cheap check for If-None-Match before loading the organizations
+        versions = await self.db.organizations.find({}, ORG_VERSION_PROJECTION).to_list(length=None)
+        return list_etag(versions, summary)
+
+    async def get_detail_etag(self, org_id: str):
+        version = await self.db.organizations.find_one({"org_id": org_id}, ORG_VERSION_PROJECTION)
+        if not version:
+            return None
+        return detail_etag(version)
+
+    async def find_slim(self, match, include_id: bool = False):
+        pipeline = [{'$match': match}] + slim_organization_stages(include_id)
+        return await self.db.organizations.aggregate(pipeline).to_list(length=None)
+
+    async def find_one_slim(self, match, include_id: bool = False):
+        pipeline = [{'$match': match}, {'$limit': 1}] + slim_organization_stages(include_id)
+        orgs = await self.db.organizations.aggregate(pipeline).to_list(length=1)
+        return orgs[0] if orgs else None
+
+    def ensure_no_inline_assets(self, org_data):
+        inline_assets = find_inline_assets(org_data)
+        if inline_assets:
+            raise ValueError(f"Inline image data is not stored on organizations, upload to S3 first: {inline_assets}")
+
+    def sign_organization_assets(self, org):
+        s3_bucket = 'drophouse-skeleton'
+        if 'mask' in org and org['mask'] != None and org['mask'] != 'null' and org['mask'] != '':
+            org['mask_id'] = org['mask']
+            org['mask'] = generate_presigned_url(org['mask'], s3_bucket)
+        if 'logo' in org and org['logo'] != None and org['logo'] != 'null' and org['logo'] != '':
+            org['logo_id'] = org['logo']
+            org['logo'] = generate_presigned_url(org['logo'], s3_bucket)
+        if 'greenmask' in org and org['greenmask'] != None and org['greenmask'] != 'null' and org['greenmask'] != '':
+            org['greenmask_id'] = org['greenmask']
+            org['greenmask'] = generate_presigned_url(org['greenmask'], s3_bucket)
+        if 'favicon' in org and org['favicon'] != None and org['favicon'] != 'null' and org['favicon'] != '':
+            org['favicon_id'] = org['favicon']
+            org['favicon'] = generate_presigned_url(org['favicon'], s3_bucket)
+
+        for products in org['landingpage']:
+            if 'asset' in products and products['asset'] != None and products['asset'] != 'null' and products['asset'] != '':
+                products['asset_id'] = products['asset']
+                products['asset'] = generate_presigned_url(products['asset'], s3_bucket)
+            if 'asset_back' in products and products['asset_back'] != None and products['asset_back'] != 'null' and products['asset_back'] != '':
+                products['asset_back_id'] = products['asset_back']
+                products['asset_back'] = generate_presigned_url(products['asset_back'], s3_bucket)
+
+        for product in org['products']:
+            if 'mask' in product and product['mask'] != None and product['mask'] != 'null' and product['mask'] != '':
+                product['mask_id'] = product['mask']
+                product['mask'] = generate_presigned_url(product['mask'], s3_bucket)
+            if 'greenmask' in product and product['greenmask'] != None and product['greenmask'] != 'null' and product['greenmask'] != '':
+                product['greenmask_id'] = product['greenmask']
+                product['greenmask'] = generate_presigned_url(product['greenmask'], s3_bucket)
+            if 'defaultProduct' in product and product['defaultProduct'] != None and product['defaultProduct'] != 'null' and product['defaultProduct'] != '':
+                product['defaultProduct_id'] = product['defaultProduct']
+                product['defaultProduct'] = generate_presigned_url(product['defaultProduct'], s3_bucket)
+
+            for color in product['colors']:
+                if product['colors'][color]['asset']['front'] != None and product['colors'][color]['asset']['front'] != 'null' and product['colors'][color]['asset']['front'] != '':
+                    product['colors'][color]['asset']['front_id'] = product['colors'][color]['asset']['front']
+                    product['colors'][color]['asset']['front'] = generate_presigned_url(product['colors'][color]['asset']['front'], s3_bucket)
+                if product['colors'][color]['asset']['back'] != None and product['colors'][color]['asset']['back'] != 'null' and product['colors'][color]['asset']['back'] != '':
+                    product['colors'][color]['asset']['back_id'] = product['colors'][color]['asset']['back']
+                    product['colors'][color]['asset']['back'] = generate_presigned_url(product['colors'][color]['asset']['back'], s3_bucket)
+        return org
 
     async def get_by_id(self, org_id: int):
         try:
-            org_data = await self.db.organizations.find_one({"org_id": org_id}, {'_id': 0})
+            org_data = await self.find_one_slim({"org_id": org_id})
             return org_data
         except Exception as e:
             logger.error(f"Error retrieving organization with ID {org_id}: {e}")
             return None
     
     async def get_organization_data(self,org_id: str):
-        organization = await self.db.organizations.find_one({"org_id": org_id})  # Replace 'organizations' with your collection name
+        organization = await self.find_one_slim({"org_id": org_id}, include_id=True)
         if not organization:
             logger.error(f"Error retrieving organization with ID {org_id}")
         return organization
@@ -1,17 +1,41 @@
+import os
+import time
+import asyncio
 import logging
 from database.BASE import BaseDatabaseOperation
 from models import PricesModel
+from utils.etag import compute_etag
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Prices change rarely, so /get_prices is served from memory and only goes
+# back to Mongo after a write or once the TTL runs out.
+PRICES_CACHE_TTL = int(os.environ.get("PRICES_CACHE_TTL", 300))
+prices_cache = {"prices": None, "etag": None, "expires_at": 0.0, "generation": 0}
+prices_cache_lock = asyncio.Lock()
+
+
+def invalidate_prices_cache():
+	# Bumping the generation also stops a read already in flight from caching
+	# what it loaded before the write
+	prices_cache["generation"] += 1
+	prices_cache["prices"] = None
+	prices_cache["etag"] = None
+	prices_cache["expires_at"] = 0.0
+
 
 class PricesOperations(BaseDatabaseOperation):
 	async def create(self, price_info: PricesModel) -> bool:
 		try:
 			price_data = price_info.model_dump()
 			result = await self.db.Prices.insert_one(price_data)
-			return result.modified_count > 0
+			created = result.inserted_id is not None
+			if created:
+				# Dropped rather than reloaded here, so a failed reload cannot
+				# turn a successful write into False; the next read reloads it
+				invalidate_prices_cache()
+			return created
 		except Exception as e:
 			logger.critical(f"Error adding price to prices: {e}")
 			return False
@@ -21,7 +45,10 @@ class PricesOperations(BaseDatabaseOperation):
 			result = await self.db.Prices.delete_one(
 				{"apparel":apparel}
 			)
-			return result.modified_count > 0
+			removed = result.deleted_count > 0
+			if removed:
+				invalidate_prices_cache()
+			return removed
 		except Exception as e:
 			logger.critical(f"Error removing price in prices: {e}")
 			return False
@@ -31,13 +58,39 @@ class PricesOperations(BaseDatabaseOperation):
 		pass
 
 	async def get(self):
-		try:
-			prices_data = await self.db.Prices.find({}, {'_id':0}).to_list(length=None)
-			if prices_data:
-				prices_dict = {price['apparel']: price['price'] for price in prices_data}
-				return prices_dict
-			else:
-				return []
-		except Exception as e:
-			logger.error(f"Error retrieving prices: {e}")
-			return []
\ No newline at end of file
+		prices, _ = await self.get_with_etag()
+		return prices
+
+	async def get_with_etag(self):
+		if self.cached_etag():
+			return prices_cache["prices"], prices_cache["etag"]
+
+		async with prices_cache_lock:
+			# Another request may have refreshed the table while we waited
+			if self.cached_etag():
+				return prices_cache["prices"], prices_cache["etag"]
+			try:
+				return await self.refresh_cache()
+			except Exception as e:
+				logger.error(f"Error retrieving prices: {e}")
+				return [], None
+
+	def cached_etag(self):
+		if prices_cache["prices"] is not None and time.monotonic() < prices_cache["expires_at"]:
+			return prices_cache["etag"]
+		return None
+
+	async def refresh_cache(self):
+		generation = prices_cache["generation"]
+		prices_data = await self.db.Prices.find({}, {'_id':0}).to_list(length=None)
+		if prices_data:
+			prices = {price['apparel']: price['price'] for price in prices_data}
+		else:
+			prices = []
+
+		etag = compute_etag(prices)
+		if prices_cache["generation"] == generation:
+			prices_cache["prices"] = prices
+			prices_cache["etag"] = etag
+			prices_cache["expires_at"] = time.monotonic() + PRICES_CACHE_TTL
+		return prices, etag
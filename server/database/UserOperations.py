@@ -4,10 +4,19 @@ from database.BASE import BaseDatabaseOperation
 from models.OrderItemModel import OrderItem
 from aws_utils import generate_presigned_url
 from pymongo import UpdateOne
+import os
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Order ids per update_many when statuses are changed in bulk
+STATUS_UPDATE_CHUNK_SIZE = int(os.environ.get("STATUS_UPDATE_CHUNK_SIZE", 500))
+
+STATUS_UPDATED = "updated"
+STATUS_UNCHANGED = "unchanged"
+STATUS_MISSING = "missing"
+STATUS_FAILED = "failed"
+
 
 class UserOperations(BaseDatabaseOperation):
 
@@ -36,9 +45,10 @@ class UserOperations(BaseDatabaseOperation):
                     for item in order["item"]:
                         img_id = item["img_id"]
                         thumbnail_img_id = "t_" + img_id
-                        item["thumbnail"] = generate_presigned_url(
-                            thumbnail_img_id, "thumbnails-cart"
-                        )
+                        if item.get("thumbnail") != 'null':
+                            item["thumbnail"] = generate_presigned_url(
+                                thumbnail_img_id, "thumbnails-cart"
+                            )
                         item["img_url"] = generate_presigned_url(
                             img_id, "browse-image-v2"
                         )
@@ -180,13 +190,12 @@ class UserOperations(BaseDatabaseOperation):
                                 greenmask = item['greenmask']
                             
                             if "toggled" in item and (type(item["toggled"]) == bool and item["toggled"] != False) and (type(item["toggled"]) == str and item["toggled"] != 'False' and item["toggled"] != 'FALSE' and item["toggled"] != 'NULL'):
-                                item["img_url"] = generate_presigned_url(
-                                    item["toggled"], "browse-image-v2"
-                                )
+                                img_key = item["toggled"]
                             else:
-                                item["img_url"] = generate_presigned_url(
-                                    img_id, "browse-image-v2"
-                                )
+                                img_key = img_id
+                            item["img_url"] = generate_presigned_url(
+                                img_key, "browse-image-v2"
+                            )
                             order["images"][
                                 item["size"]
                                 + "_"
@@ -214,6 +223,15 @@ class UserOperations(BaseDatabaseOperation):
                                 + "_"
                                 + str(prevent_duplicate)
                             ]["img_id"] = item["img_id"]
+                            order["images"][
+                                item["size"]
+                                + "_"
+                                + fname
+                                + "_"
+                                + lname
+                                + "_"
+                                + str(prevent_duplicate)
+                            ]["img_key"] = img_key
                             order["images"][
                                 item["size"]
                                 + "_"
@@ -291,6 +309,41 @@ class UserOperations(BaseDatabaseOperation):
                 return False
             
 
+    async def update_status_many(self, order_ids, new_status: str, reason=''):
+        # Sets one status on many orders, STATUS_UPDATE_CHUNK_SIZE per update_many.
+        # Returns {order_id: updated | unchanged | missing | failed}
+        outcomes = {}
+        order_ids = list(dict.fromkeys(order_ids))
+        for start in range(0, len(order_ids), STATUS_UPDATE_CHUNK_SIZE):
+            chunk = order_ids[start:start + STATUS_UPDATE_CHUNK_SIZE]
+            try:
+                current = {
+                    order["order_id"]: order
+                    async for order in self.db.orders.find(
+                        {"order_id": {"$in": chunk}}, {"_id": 0, "order_id": 1, "status": 1, "reason": 1}
+                    )
+                }
+                to_update = [
+                    order_id for order_id in chunk
+                    if order_id in current
+                    and (current[order_id].get("status"), current[order_id].get("reason")) != (new_status, reason)
+                ]
+                if to_update:
+                    await self.db.orders.update_many(
+                        {"order_id": {"$in": to_update}}, {"$set": {"status": new_status, "reason": reason}}
+                    )
+                updated = set(to_update)
+                for order_id in chunk:
+                    if order_id not in current:
+                        outcomes[order_id] = STATUS_MISSING
+                    else:
+                        outcomes[order_id] = STATUS_UPDATED if order_id in updated else STATUS_UNCHANGED
+            except Exception as e:
+                logger.critical(f"Error in updating order status to {new_status} for {len(chunk)} orders: {e}")
+                for order_id in chunk:
+                    outcomes[order_id] = STATUS_FAILED
+        return outcomes
+
     async def check_student_order(self, user_id: str):
         try:
             result = await self.db.users.find_one(
@@ -10,9 +10,17 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from utils.format_error import format_error
 from routers import admin_dashboard_router, org_router, prices_router, order_info_router, bulk_order_router
+from routers.admin_dashboard import resume_download_jobs
 import uvicorn
 import logging
 from db import connect_to_mongo, close_mongo_connection
+from utils.warmup import start_warmup, wait_until_ready, is_ready, warmup_state, WARMUP_GATE_TIMEOUT
+from utils.process_pool import start_image_pool, shutdown_image_pool
+from utils.image_fetcher import close_image_fetcher
+from utils.vectorizer_client import close_vectorizer_client
+from utils.job_workspace import remove_stale_workspaces
+from utils.download_jobs import cancel_download_jobs
+from utils.generate_vector_ai import shutdown_eps_raster_pool
 import firebase_admin
 from firebase_admin import credentials
 from starlette.exceptions import HTTPException as StarletteHTTPException
@@ -52,6 +60,14 @@ async def grace_shutdown(signal, loop):
     # Add any other shutdown cleanup logic (e.g., closing Redis if you're using it)
     loop.stop()
 
+WARMUP_UNGATED_PATHS = {"/", "/ready"}
+
+@app.middleware("http")
+async def warmup_gate_middleware(request: Request, call_next):
+    if WARMUP_GATE_TIMEOUT > 0 and request.url.path not in WARMUP_UNGATED_PATHS and not is_ready():
+        await wait_until_ready(WARMUP_GATE_TIMEOUT)
+    return await call_next(request)
+
 @app.middleware("http")
 async def session_middleware(request: Request, call_next):
     response = await call_next(request)
@@ -69,6 +85,10 @@ async def session_middleware(request: Request, call_next):
 def root():
     return {"message": "Welcome to the New Order!!!"}
 
+@app.get("/ready")
+def ready():
+    return JSONResponse(status_code=200 if is_ready() else 503, content=warmup_state)
+
 SEND_EMAIL_FOR_STATUS_CODES = {429, 500}
 
 @app.exception_handler(StarletteHTTPException)
@@ -92,7 +112,16 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 
 # Add event handlers
 app.add_event_handler("startup", connect_to_mongo)
+app.add_event_handler("startup", start_image_pool)
+app.add_event_handler("startup", start_warmup)
+app.add_event_handler("startup", remove_stale_workspaces)
+app.add_event_handler("startup", resume_download_jobs)
+app.add_event_handler("shutdown", cancel_download_jobs)
 app.add_event_handler("shutdown", close_mongo_connection)
+app.add_event_handler("shutdown", shutdown_image_pool)
+app.add_event_handler("shutdown", close_image_fetcher)
+app.add_event_handler("shutdown", close_vectorizer_client)
+app.add_event_handler("shutdown", shutdown_eps_raster_pool)
 app.include_router(admin_dashboard_router)
 app.include_router(org_router)
 app.include_router(prices_router)
@@ -1,20 +1,19 @@
 import os
 import logging
-import requests
 import asyncio
 import traceback
-import base64
 from db import get_db_ops
 from bson import json_util
 from fastapi import Depends
 from dotenv import load_dotenv
 from pydantic import BaseModel
 from typing import List
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, RedirectResponse
 from inspect import currentframe, getframeinfo
 from database.BASE import BaseDatabaseOperation
 from database.OrganizationOperation import OrganizationOperation
-from fastapi import APIRouter, Body, HTTPException, BackgroundTasks, WebSocket
+from fastapi import APIRouter, Body, HTTPException, Request, WebSocket
+from starlette.requests import HTTPConnection
 from database.UserOperations import UserOperations
 from database.OrderOperations import OrderOperations
 from email_service.EmailService import EmailService
@@ -22,15 +21,36 @@ from models.OrderItemModel import OrderItem
 from aws_utils import generate_presigned_url
 from utils.printful_util import (
     applyMask_and_removeBackground,
+    applyMask_and_removeBackground_batch,
+    batch_by_mask,
+    order_image_source,
+    MASK_BATCH_SIZE,
     printful_request,
-    products_and_variants_map,
+    get_products_and_variants_map,
+)
+from utils.mask_cache import mask_cache
+from utils.process_pool import image_pool
+from utils.image_fetcher import image_fetcher, browse_image_cache_key
+from utils.vectorizer_client import vectorizer_client
+from utils.order_status import OrderStatusBatch
+from utils.stage_pipeline import Stage, StagePipeline
+from utils.download_jobs import (
+    DownloadJob,
+    DownloadJobError,
+    COMPLETED,
+    download_jobs,
+    write_zip,
+    store_artifact,
+    artifact_url,
 )
 from utils.generate_vector_ai import (
     generate_vector_image,
-    generate_zip,
-    generate_pdf,
-    clean_old_data,
-    convert_eps_to_base64,
+    load_cached_vector,
+    vector_cache_key,
+    vector_cache,
+    eps_preview,
+    EPS_PREVIEW_DPI,
+    EPS_PREVIEW_MAX_DPI,
 )
 
 allowedUsers = [
@@ -42,7 +62,10 @@ allowedUsers = [
 
 email_service = EmailService()
 HARD_CODED_PASSWORD = 'Drophouse23#'
-vector_task_storage = {}
+# Mask batches of a student download in flight at once. Each holds up to
+# MASK_BATCH_SIZE fetched and masked images until the vectorizer takes them,
+# so the default keeps about 100 images in memory per job
+DOWNLOAD_BATCH_CONCURRENCY = int(os.environ.get("DOWNLOAD_BATCH_CONCURRENCY", max(1, 100 // MASK_BATCH_SIZE)))
 class DeleteRequest(BaseModel):
     user_id: str
     order_id: str
@@ -53,6 +76,19 @@ class DownloadRequest(BaseModel):
     order_ids: list[str]
     task_id: str
 
+class ResumeRequest(BaseModel):
+    password: str
+
+def admin_password_ok(connection: HTTPConnection):
+    # GET routes and the progress websocket have no body, so the password comes
+    # as a header or, for download links and browser websockets, a query parameter
+    password = connection.headers.get("x-admin-password") or connection.query_params.get("password")
+    return password == HARD_CODED_PASSWORD
+
+async def require_admin_password(request: Request):
+    if not admin_password_ok(request):
+        raise HTTPException(status_code=403, detail="Invalid password")
+
 class EmailRequest(BaseModel):
     to_mail: str
     reason: str
@@ -271,7 +307,7 @@ async def print_order(
     org_db_ops: BaseDatabaseOperation = Depends(get_db_ops(OrganizationOperation)),
 ):
     try:
-        printful_mapping = products_and_variants_map()
+        printful_mapping = await get_products_and_variants_map()
         if not hasattr(order_info, 'org_id'):
             logger.error(f"Organization id not found in request", exc_info=True)
             raise HTTPException(
@@ -283,9 +319,9 @@ async def print_order(
             )
 
         organization = await org_db_ops.get_by_id(order_info.org_id)
-        mask_data = process_mask_data(organization, False)
+        mask_data = await mask_cache.get_for_organization(organization)
 
-        if not mask_data or mask_data == None:
+        if mask_data is None:
             mask_data = "pending"
             for item in order_info.item:
                 if not hasattr(item, 'greenmask'):
@@ -293,7 +329,10 @@ async def print_order(
                     break
                 else:
                     if hasattr(item, 'greenmask') and item.greenmask != 'null' and item.greenmask != '':
-                        item.greenmask = process_mask_data(item.greenmask, True)
+                        item.greenmask = await mask_cache.get(item.greenmask)
+                        if item.greenmask is None:
+                            mask_data = None
+                            break
                     else:
                         mask_data = None
                         break
@@ -301,7 +340,7 @@ async def print_order(
             for item in order_info.item:
                 item.greenmask = mask_data
         
-        if not mask_data or mask_data == None:
+        if mask_data is None:
             logger.error(f"Green mask not found in request", exc_info=True)
             raise HTTPException(
                 status_code=404,
@@ -405,7 +444,8 @@ async def print_order(
             )
             print('image url -> ', image_url)
             image_data = await applyMask_and_removeBackground(
-                image_url, item.greenmask, item.img_id
+                image_url, item.greenmask, item.img_id,
+                cache_key=None if item.toggled else browse_image_cache_key(item.img_id),
             )
 
             item_data = {
@@ -514,94 +554,119 @@ async def get_variants(product_id):
 
 
 @admin_dashboard_router.get("/get_product_map")
-async def get_products_and_variants_map():
-    return products_and_variants_map()
+async def get_product_map(refresh: bool = False):
+    return await get_products_and_variants_map(refresh)
+
+@admin_dashboard_router.get("/metrics/mask_cache")
+async def get_mask_cache_metrics():
+    return mask_cache.metrics()
+
+@admin_dashboard_router.get("/metrics/image_pool")
+async def get_image_pool_metrics():
+    return image_pool.metrics()
+
+@admin_dashboard_router.get("/metrics/image_fetcher")
+async def get_image_fetcher_metrics():
+    return image_fetcher.metrics()
 
-@admin_dashboard_router.post("/download_student_verified_orders")
+@admin_dashboard_router.get("/metrics/download_pipeline")
+async def get_download_pipeline_metrics():
+    return download_pipeline.metrics()
+
+@admin_dashboard_router.get("/metrics/vectorizer")
+async def get_vectorizer_metrics():
+    return {**vectorizer_client.metrics(), "cache": vector_cache.metrics()}
+
+@admin_dashboard_router.post("/download_student_verified_orders", status_code=202)
 async def download_student_verified_orders(
     request: DownloadRequest,
-    background_tasks: BackgroundTasks,
     db_ops: BaseDatabaseOperation = Depends(get_db_ops(UserOperations)),
     org_db_ops: BaseDatabaseOperation = Depends(get_db_ops(OrganizationOperation)),
 ):
+    # Only queues the job; progress comes from /download_jobs/{task_id} (or the
+    # progress websocket) and the archive from /download_jobs/{task_id}/artifact
     if request.password != HARD_CODED_PASSWORD:
         raise HTTPException(status_code=403, detail="Invalid password")
     try:
-        await clean_old_data()
-        vector_task_storage[request.task_id] = {
-            'success': 0,
-            'failed': 0,
-            'progress': 0,
-            'total': len(request.order_ids)
-        }
-        result = await db_ops.get_student_order(request.order_ids)
-        if result:
-            tasks = []
-            for order in result:
-                if "images" in order:
-                    if 'org_id' not in order:
-                        logger.error(f"Organization id not found in ORDER", exc_info=True)
-                        vector_task_storage.pop(request.task_id, None)
-                        raise HTTPException(
-                            status_code=404,
-                            detail={
-                                "message": "Org Id not found",
-                                "currentFrame": getframeinfo(currentframe()),
-                            },
-                        )
-
-                    organization = await org_db_ops.get_by_id(order['org_id'])
-                    mask_data = process_mask_data(organization, False)
-
-                    if not mask_data or mask_data == None:
-                        mask_data = "pending"
-                        for image in order['images']:
-                            if 'greenmask' not in order['images'][image]:
-                                mask_data = None
-                                break
-                            else:
-                                if 'greenmask' in order['images'][image] and order['images'][image]['greenmask'] != 'null' and order['images'][image]['greenmask'] != '':
-                                    order['images'][image]['greenmask'] = process_mask_data(order['images'][image]['greenmask'], True)
-                                else:
-                                    mask_data = None
-                                    break
-                    else:
-                        for image in order['images']:
-                            order['images'][image]['greenmask'] = mask_data
-                    
-                    if not mask_data or mask_data == None:
-                        logger.error(f"Green mask not found in request", exc_info=True)
-                        vector_task_storage.pop(request.task_id, None)
-                        raise HTTPException(
-                            status_code=404,
-                            detail={
-                                "message": "Green mask not found",
-                                "currentFrame": getframeinfo(currentframe()),
-                            },
-                        )
-                    
-                    for image in order["images"]:
-                        tasks.append(process_image(image, order['images'][image]['greenmask'], order, request.mode, db_ops, request.task_id))
-            
-            await asyncio.gather(*tasks, return_exceptions=True)
-
-            zip_path = await generate_zip(background_tasks)  # Generate folder as zip and download
-            if not os.path.exists(zip_path):
-                vector_task_storage.pop(request.task_id, None)
-                return JSONResponse(
-                    content={"error": f"File not found: {zip_path}"}
-                )
-
-            vector_task_storage.pop(request.task_id, None)
-            return FileResponse(zip_path, filename="student_products.zip")
-        else:
-            vector_task_storage.pop(request.task_id, None)
-            return JSONResponse(content=[])
-    except HTTPException as http_ex:
-        raise http_ex
+        job = DownloadJob(
+            request.task_id,
+            len(request.order_ids),
+            "student_products.zip",
+            params={"mode": request.mode, "order_ids": request.order_ids},
+        )
+        download_jobs.submit(job, lambda job: run_student_download(job, db_ops, org_db_ops))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"message": str(e), "currentFrame": getframeinfo(currentframe())})
+    except DownloadJobError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "currentFrame": getframeinfo(currentframe())})
+    return job.state
+
+@admin_dashboard_router.post("/download_jobs/{task_id}/resume", status_code=202)
+async def resume_download_job(
+    task_id: str,
+    request: ResumeRequest,
+    db_ops: BaseDatabaseOperation = Depends(get_db_ops(UserOperations)),
+    org_db_ops: BaseDatabaseOperation = Depends(get_db_ops(OrganizationOperation)),
+):
+    # Continues a failed or interrupted job: finished files are reused and only
+    # the rest of the images are vectorized
+    if request.password != HARD_CODED_PASSWORD:
+        raise HTTPException(status_code=403, detail="Invalid password")
+    try:
+        job = download_jobs.resumable(task_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail={"message": "No checkpoint for this job", "currentFrame": getframeinfo(currentframe())})
+        download_jobs.submit(job, lambda job: run_student_download(job, db_ops, org_db_ops))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"message": str(e), "currentFrame": getframeinfo(currentframe())})
+    except DownloadJobError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "currentFrame": getframeinfo(currentframe())})
+    return job.state
+
+async def resume_download_jobs():
+    # Startup: picks up jobs a restart interrupted
+    db_ops = get_db_ops(UserOperations)()
+    org_db_ops = get_db_ops(OrganizationOperation)()
+    download_jobs.restore(lambda job: run_student_download(job, db_ops, org_db_ops))
+
+@admin_dashboard_router.get("/download_jobs/{task_id}", dependencies=[Depends(require_admin_password)])
+async def get_download_job(task_id: str):
+    job = download_jobs.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail={"message": "Job not found", "currentFrame": getframeinfo(currentframe())})
+    return job.state
+
+@admin_dashboard_router.get("/download_jobs/{task_id}/artifact", dependencies=[Depends(require_admin_password)])
+async def get_download_job_artifact(task_id: str):
+    job = download_jobs.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail={"message": "Job not found", "currentFrame": getframeinfo(currentframe())})
+    if job.status != COMPLETED:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": f"Job is {job.status}", "currentFrame": getframeinfo(currentframe()), "detail": job.state["error"]},
+        )
+    if job.artifact_key:
+        return RedirectResponse(await asyncio.to_thread(artifact_url, job), status_code=307)
+    if not job.artifact_path or not os.path.exists(job.artifact_path):
+        raise HTTPException(status_code=410, detail={"message": "Artifact expired", "currentFrame": getframeinfo(currentframe())})
+    return FileResponse(job.artifact_path, filename=job.filename)
+
+@admin_dashboard_router.get("/download_jobs/{task_id}/previews/{image}", dependencies=[Depends(require_admin_password)])
+async def get_download_job_preview(task_id: str, image: str, dpi: int = EPS_PREVIEW_DPI):
+    # PNG of one vectorized image of a job, rendered once per resolution
+    job = download_jobs.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail={"message": "Job not found", "currentFrame": getframeinfo(currentframe())})
+    if not 1 <= dpi <= EPS_PREVIEW_MAX_DPI:
+        raise HTTPException(status_code=400, detail={"message": f"dpi must be between 1 and {EPS_PREVIEW_MAX_DPI}", "currentFrame": getframeinfo(currentframe())})
+    eps_path = os.path.join(job.workspace.files, image.split("_", 1)[0], f"{image}.eps")
+    if os.path.basename(image) != image or not os.path.isfile(eps_path):
+        raise HTTPException(status_code=404, detail={"message": "Image not found", "currentFrame": getframeinfo(currentframe())})
+    try:
+        return FileResponse(await eps_preview(eps_path, dpi), media_type="image/png")
     except Exception as e:
-        logger.error(f"Error in download_student_verified_orders: {str(e)}", exc_info=True)
-        # vector_task_storage.pop(request.task_id, None)
+        logger.error(f"Error rendering preview for {image}: {str(e)}", exc_info=True)
         raise HTTPException(
             status_code=500,
             detail={
@@ -611,77 +676,198 @@ async def download_student_verified_orders(
             },
         )
 
-semaphore = asyncio.Semaphore(100)  # Limit to 100 concurrent tasks
-async def process_image(image, mask_data, order, mode, db_ops, task_id):
-    async with semaphore:
-        try:
-            image_data = await applyMask_and_removeBackground(
-                order["images"][image]["img_path"],
-                mask_data,
-                order["images"][image]["img_id"],
-            )
-            result = await generate_vector_image(image_data, image, mode)
-            if result:
-                logger.info(f"Vector Generated: {image}")
-                vector_task_storage[task_id]['success'] = vector_task_storage[task_id]['success'] + 1
-                if mode == 'production':  # Update order status
-                    is_updated = await db_ops.update(order["user_id"], order["order_id"], "prepared")
-                    if is_updated:
-                        logger.info(f"Status updated: {image}")
+async def run_student_download(job, db_ops, org_db_ops):
+    workspace = job.workspace
+    mode = job.params["mode"]
+    result = await db_ops.get_student_order(job.params["order_ids"])
+    # Files finished by an earlier run of this job go into the archive as they are
+    done = job.checkpoint.completed_files()
+    job.state["success"] = len(done)
+    images = []
+    done_orders = []
+    for order in result or []:
+        if "images" in order:
+            if 'org_id' not in order:
+                logger.error(f"Organization id not found in ORDER", exc_info=True)
+                raise DownloadJobError("Org Id not found")
+
+            organization = await org_db_ops.get_by_id(order['org_id'])
+            mask_data = await mask_cache.get_for_organization(organization)
+
+            if mask_data is None:
+                mask_data = "pending"
+                for image in order['images']:
+                    if 'greenmask' not in order['images'][image]:
+                        mask_data = None
+                        break
                     else:
-                        logger.error(f"Not able to update status, Error: {image}")
+                        if 'greenmask' in order['images'][image] and order['images'][image]['greenmask'] != 'null' and order['images'][image]['greenmask'] != '':
+                            order['images'][image]['greenmask'] = await mask_cache.get(order['images'][image]['greenmask'])
+                            if order['images'][image]['greenmask'] is None:
+                                mask_data = None
+                                break
+                        else:
+                            mask_data = None
+                            break
             else:
-                vector_task_storage[task_id]['failed'] = vector_task_storage[task_id]['failed'] + 1
-                logger.error(f"Vector Error: {image}")
-        except Exception as e:
-            vector_task_storage[task_id]['failed'] = vector_task_storage[task_id]['failed'] + 1
-            logger.error(f"Error processing image {image}: {str(e)}", exc_info=True)
+                for image in order['images']:
+                    order['images'][image]['greenmask'] = mask_data
+
+            if mask_data is None:
+                logger.error(f"Green mask not found in request", exc_info=True)
+                raise DownloadJobError("Green mask not found")
+
+            for image in order["images"]:
+                if image in done:
+                    done_orders.append(order)
+                else:
+                    images.append((order, image))
+
+    # Images sharing a mask are masked together, DOWNLOAD_BATCH_CONCURRENCY
+    # batches at a time. Each finished vector goes into the archive while the
+    # rest are still being produced
+    completed = asyncio.Queue()
+    # Production runs mark orders prepared, in one update per finished batch
+    statuses = OrderStatusBatch(db_ops, "prepared") if mode == 'production' else None
+    if statuses is not None:
+        # The earlier run may have stopped before its last update
+        for order in done_orders:
+            statuses.add(order)
+
+    async def run_batch(mask_data, batch):
+        await process_image_batch(batch, mask_data, mode, statuses, job.job_id, workspace.files, completed)
+        if statuses is not None:
+            await statuses.flush()
+
+    batches = list(batch_by_mask(images, lambda entry: entry[0]["images"][entry[1]]["greenmask"]))
+    batch_errors = []
+
+    async def run_pipeline():
+        try:
+            results = await download_pipeline.run((run_batch, mask_data, batch) for mask_data, batch in batches)
+            for batch, error in results:
+                if error is not None:
+                    # Images of the batch that never reported are counted as failed
+                    logger.error(f"Batch of {len(batch)} images failed in job {job.job_id}: {error}", exc_info=error)
+                    batch_errors.append((batch, error))
+        finally:
+            completed.put_nowait(None)
+
+    async def finished_files():
+        pipeline = asyncio.create_task(run_pipeline())
+        try:
+            for path in done.values():
+                yield os.path.relpath(path, workspace.files), path
+            while (finished := await completed.get()) is not None:
+                image, path = finished
+                await asyncio.to_thread(job.checkpoint.record, image, path)
+                yield os.path.relpath(path, workspace.files), path
+        finally:
+            pipeline.cancel()
+
+    zip_path = await write_zip(finished_files(), workspace.path(job.filename))
+    if statuses is not None:
+        await statuses.flush()
+        job.state["status_updates"] = statuses.summary()
+        job.state["status_failures"] = statuses.failed()
+    if batch_errors:
+        reported = job.state["success"] + job.state["failed"]
+        job.state["failed"] += max(0, len(done) + len(images) - reported)
+        if statuses is not None:
+            failed_orders = {order["order_id"] for batch, _ in batch_errors for order, _ in batch}
+            job.state["status_failures"] = sorted(set(job.state["status_failures"]) | (failed_orders - set(statuses.outcomes)))
+        # The archive would be missing whole batches; the job can be resumed once the cause is fixed
+        raise Exception(f"{len(batch_errors)} of {len(batches)} batches failed: {batch_errors[0][1]}")
+    # Images that could not be vectorized are missing from the archive
+    job.state["partial"] = job.state["failed"] > 0
+    await store_artifact(job, zip_path)
+
+async def run_download_batch(item):
+    # A failed batch is reported rather than raised, so the job's other batches still run
+    run_batch, mask_data, batch = item
+    try:
+        await run_batch(mask_data, batch)
+        return batch, None
+    except Exception as error:
+        return batch, error
+
+download_pipeline = StagePipeline("student_download", [
+    Stage("batch", run_download_batch, DOWNLOAD_BATCH_CONCURRENCY),
+])
+
+async def process_image_batch(batch, mask_data, mode, statuses, task_id, output_dir, completed=None):
+    # Images vectorized before with the same mask and mode come from the cache
+    # and skip both masking and vectorizer.ai
+    cache_keys = [
+        vector_cache_key(order["images"][image].get("img_key") or order["images"][image]["img_id"], mask_data.digest, mode)
+        for order, image in batch
+    ]
+    cached = await asyncio.gather(*[
+        load_cached_vector(cache_key, image, output_dir) for (_, image), cache_key in zip(batch, cache_keys)
+    ], return_exceptions=True)
+    hits = []
+    pending = []
+    for (order, image), cache_key, result in zip(batch, cache_keys, cached):
+        if isinstance(result, str):
+            logger.info(f"Vector reused from cache: {image}")
+            hits.append(process_image(image, None, order, mode, statuses, task_id, output_dir, cached_path=result, completed=completed))
+        else:
+            pending.append(((order, image), cache_key))
+    await asyncio.gather(*hits)
+    if not pending:
+        return
+
+    try:
+        masked_images = await applyMask_and_removeBackground_batch(
+            [(*order_image_source(order["images"][image]), order["images"][image]["img_id"]) for (order, image), _ in pending],
+            mask_data,
+        )
+    except Exception as e:
+        masked_images = [e] * len(pending)
+    await asyncio.gather(*[
+        process_image(image, image_data, order, mode, statuses, task_id, output_dir, cache_key, completed=completed)
+        for ((order, image), cache_key), image_data in zip(pending, masked_images)
+    ])
+
+async def process_image(image, image_data, order, mode, statuses, task_id, output_dir, cache_key=None, cached_path=None, completed=None):
+    try:
+        if isinstance(image_data, Exception):
+            raise image_data
+        result = cached_path or await generate_vector_image(image_data, image, mode, output_dir, cache_key)
+        await record_vector_result(result, image, order, statuses, task_id)
+        if result and completed is not None:
+            completed.put_nowait((image, result))
+    except Exception as e:
+        download_jobs.progress(task_id)['failed'] += 1
+        logger.error(f"Error processing image {image}: {str(e)}", exc_info=True)
+
+async def record_vector_result(result, image, order, statuses, task_id):
+    if result:
+        logger.info(f"Vector Generated: {image}")
+        download_jobs.progress(task_id)['success'] += 1
+        if statuses is not None:  # Production runs mark the order prepared
+            statuses.add(order)
+    else:
+        download_jobs.progress(task_id)['failed'] += 1
+        logger.error(f"Vector Error: {image}")
 
 @admin_dashboard_router.websocket("/ws/progress/{task_id}")
 async def websocket_progress(websocket: WebSocket, task_id: str):
+    if not admin_password_ok(websocket):
+        # Policy violation; closing before accept rejects the handshake
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
     try:
         while True:
-            if task_id in vector_task_storage:
-                await websocket.send_json(vector_task_storage[task_id])
-            else:
+            job = download_jobs.get(task_id)
+            if job is None:
+                break
+            await websocket.send_json(job.state)
+            if job.finished:
                 break
             await asyncio.sleep(5)
     except Exception as e:
         logger.info(f"WebSocket error: {e}")
     finally:
         await websocket.close()
-
-def process_mask_data(organization, isImgId):
-    if not organization:
-        return None
-
-    if not isImgId:
-        if 'greenmask' in organization and organization['greenmask'] != 'null' and organization['greenmask'] != '':
-            mask_data = organization['greenmask']
-        else:
-            return None
-    else:
-        if organization != None and organization != "":
-            mask_data = organization
-        else:
-            return None
-    
-    if isinstance(mask_data, bytes) and mask_data.startswith(b'data:image'):
-        mask_data = mask_data.split(b',')[1]
-    else:
-        try:
-            if not mask_data or mask_data == None:
-                return None
-
-            mask_data = generate_presigned_url(mask_data, "drophouse-skeleton")
-            response = requests.get(mask_data)
-            if response.status_code == 200:
-                mask_data = base64.b64encode(response.content)
-            else:
-                raise ValueError(f"Error downloading image. Status code: {response.status_code}")
-        except Exception as e:
-            logger.info(f"Error processing mask data: {e}")
-            mask_data = None
-
-    return mask_data
\ No newline at end of file
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, WebSocket
+from fastapi import APIRouter, HTTPException, Depends, WebSocket
 from models.bulkordermodel import BulkOrderRequest
 from models.regeneratemodel import Regenerate
 from models.reorder import Reorder
@@ -7,8 +7,7 @@ from models.ShippingModel import ShippingModel
 from models.ItemModel import ItemModel
 from ai_models.utils import generate_prompts, generate_images, generate_three_images, generate_three_prompts
 from routers.order_info import PlaceOrderDataRequest, place_order
-from fastapi.responses import JSONResponse, FileResponse
-from aws_utils import generate_presigned_url, processAndSaveImage
+from aws_utils import generate_presigned_url, processAndSaveImage, uploadImageBytes
 from inspect import currentframe, getframeinfo
 from database.OrderOperations import OrderOperations
 from database.UserOperations import UserOperations
@@ -20,16 +19,27 @@ import traceback
 from typing import List
 import datetime
 import random
-from bson import json_util
 import logging
 import uuid
 import os
-from utils.printful_util import applyMask_and_removeBackground_file
-from utils.generate_vector_ai import generate_zip_pre, generate_pdf_pre, clean_old_data_prepared
-from PIL import Image
-import requests
-from io import BytesIO
-import base64
+from utils.printful_util import (
+    batch_by_mask,
+    order_image_source,
+    check_backgrounds,
+    render_masked_png_files,
+    write_files,
+)
+from utils.mask_cache import mask_cache
+from utils.process_pool import run_in_pool, IMAGE_POOL_WORKERS
+from utils.stage_pipeline import Stage, StagePipeline
+from utils.order_status import OrderStatusBatch
+from utils.image_fetcher import image_fetcher, browse_image_cache_key
+from utils.image_payload import ImagePayload
+from utils.thumbnail_compositor import render_thumbnail_batch, THUMBNAIL_BATCH_SIZE
+from utils.generate_vector_ai import generate_pdf_pre, zip_response
+from utils.job_workspace import JobWorkspace
+import hashlib
+import json
 import asyncio
 
 bulk_order_router = APIRouter()
@@ -39,18 +49,56 @@ logger = logging.getLogger(__name__)
 ag_task_storage = {}
 min_retry = 10
 
+# bulk_prepare runs mask batches through fetch -> process -> write stages,
+# each with its own number of workers and a bounded queue in front of it
+PREPARE_FETCH_CONCURRENCY = int(os.environ.get("PREPARE_FETCH_CONCURRENCY", 4))
+PREPARE_PROCESS_CONCURRENCY = int(os.environ.get("PREPARE_PROCESS_CONCURRENCY", max(1, IMAGE_POOL_WORKERS)))
+PREPARE_WRITE_CONCURRENCY = int(os.environ.get("PREPARE_WRITE_CONCURRENCY", 2))
+PREPARE_QUEUE_SIZE = int(os.environ.get("PREPARE_QUEUE_SIZE", 0)) or None
+
+async def fetch_prepare_batch(item):
+    statuses, mask_data, batch = item
+    sources = [order_image_source(order["images"][image]) for order, image, _ in batch]
+    backgrounds = await image_fetcher.fetch_many([url for url, _ in sources], [cache_key for _, cache_key in sources])
+    return statuses, mask_data, batch, check_backgrounds(backgrounds)
+
+async def process_prepare_batch(item):
+    statuses, mask_data, batch, backgrounds = item
+    return statuses, batch, await render_masked_png_files(mask_data, backgrounds)
+
+async def write_prepare_batch(item):
+    statuses, batch, pngs = item
+    await asyncio.to_thread(write_files, [image_path for _, _, image_path in batch], pngs)
+    # Shipped once the whole run has been written, see bulk_prepare
+    for order, _, _ in batch:
+        statuses.add(order)
+    return batch
+
+prepare_pipeline = StagePipeline("bulk_prepare", [
+    Stage("fetch", fetch_prepare_batch, PREPARE_FETCH_CONCURRENCY, PREPARE_QUEUE_SIZE),
+    Stage("process", process_prepare_batch, PREPARE_PROCESS_CONCURRENCY, PREPARE_QUEUE_SIZE),
+    Stage("write", write_prepare_batch, PREPARE_WRITE_CONCURRENCY, PREPARE_QUEUE_SIZE),
+])
+
+@bulk_order_router.get("/metrics/prepare_pipeline")
+async def get_prepare_pipeline_metrics():
+    return prepare_pipeline.metrics()
+
 @bulk_order_router.post("/bulk-download-prepared_orders")
 async def bulk_prepare(
-    background_tasks: BackgroundTasks,
     order_ids: List[str],
     db_ops: BaseDatabaseOperation = Depends(get_db_ops(UserOperations)),
     order_db_ops: BaseDatabaseOperation = Depends(get_db_ops(OrderOperations)),
     org_db_ops: BaseDatabaseOperation = Depends(get_db_ops(OrganizationOperation)),
 ):
+    workspace = JobWorkspace(uuid.uuid4().hex)
+    images_dir = workspace.path("images")
     try:
-        clear_old = await clean_old_data_prepared()
+        await asyncio.to_thread(workspace.create)
         # mask_image_path = "./images/masks/elephant_mask.png"
         result = await db_ops.get_student_order(order_ids)
+        prepared_images = []
+        statuses = OrderStatusBatch(db_ops, "shipped")
         if result:
             for order in result:
                 if "images" in order:
@@ -66,9 +114,9 @@ async def bulk_prepare(
                         # )
 
                     organization = await org_db_ops.get_by_id(order['org_id'])
-                    mask_data = process_mask_data(organization, False)
+                    mask_data = await mask_cache.get_for_organization(organization)
 
-                    if not mask_data or mask_data == None:
+                    if mask_data is None:
                         mask_data = "pending"
                         for image in order['images']:
                             if 'greenmask' not in order['images'][image]:
@@ -76,7 +124,10 @@ async def bulk_prepare(
                                 break
                             else:
                                 if 'greenmask' in order['images'][image] and order['images'][image]['greenmask'] != 'null' and order['images'][image]['greenmask'] != '':
-                                    order['images'][image]['greenmask'] = process_mask_data(order['images'][image]['greenmask'], True)
+                                    order['images'][image]['greenmask'] = await mask_cache.get(order['images'][image]['greenmask'])
+                                    if order['images'][image]['greenmask'] is None:
+                                        mask_data = None
+                                        break
                                 else:
                                     mask_data = None
                                     break
@@ -84,7 +135,7 @@ async def bulk_prepare(
                         for image in order['images']:
                             order['images'][image]['greenmask'] = mask_data
                     
-                    if not mask_data or mask_data == None:
+                    if mask_data is None:
                         logger.error(f"Green mask not found in request", exc_info=True)
                         raise HTTPException(
                             status_code=404,
@@ -96,99 +147,97 @@ async def bulk_prepare(
                         
                     for image in order["images"]:
                         size = image.split("_", 1)[0]
-                        zip_folder1 = f"/mnt/data/student_module_zip_download1/temp_student_products/{size}"
-                        if not os.path.exists(zip_folder1):
-                            os.makedirs(zip_folder1)
-                        image_path = f"{zip_folder1}/{image}.png"
-                        image_data = applyMask_and_removeBackground_file(
-                            order["images"][image]["img_path"],
-                            order["images"][image]["greenmask"],
-                            order["images"][image]["img_id"],
-                            image_path
-                        )
-                        
-                        is_updated = await db_ops.update(order["user_id"], order["order_id"], "shipped")
-                        if is_updated:
-                            logger.info(f"Status updated : {image}")
-                        else:
-                            logger.error(f"Not able to update status, Error: {image}")
-        zip_path = await generate_pdf_pre(background_tasks)
-        if not os.path.exists(zip_path):
-            return JSONResponse(
-                content=json_util.dumps({"error": f"File not found: {zip_path}"})
-            )
-
-        return FileResponse(zip_path, filename=f"prepared_orders.zip")
+                        size_folder = os.path.join(images_dir, size)
+                        os.makedirs(size_folder, exist_ok=True)
+                        prepared_images.append((order, image, f"{size_folder}/{image}.png"))
+
+            # Images sharing a mask are masked together; batches move through
+            # the prepare stages side by side
+            batches = batch_by_mask(prepared_images, lambda entry: entry[0]["images"][entry[1]]["greenmask"])
+            await prepare_pipeline.run((statuses, mask_data, batch) for mask_data, batch in batches)
+            await statuses.flush()
+        # Each size's PDF is streamed as soon as it is rendered; the workspace
+        # is removed once the archive has been sent
+        response = zip_response(generate_pdf_pre(workspace, images_dir), "prepared_orders.zip", workspace)
+        # Outcome counts; orders that could not be updated are logged by the batch
+        response.headers["X-Status-Updates"] = json.dumps(statuses.summary())
+        return response
 
     except HTTPException as http_ex:
+        workspace.cleanup()
         raise http_ex
     except Exception as e:
+        workspace.cleanup()
         logger.error(f"Error in bulk order session: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail={'message': "Internal Server Error", 'currentFrame': getframeinfo(currentframe()), 'detail': str(traceback.format_exc())})
 
-def strip_base64_prefix(base64_str):
-    if base64_str.startswith('data:image/png;base64,'):
-        return base64_str[len('data:image/png;base64,'):]
-    return base64_str
-
-def correct_base64_padding(base64_str):
-    padding = len(base64_str) % 4
-    if padding != 0:
-        base64_str += '=' * (4 - padding)
-    return base64_str
-
-def percentage_to_pixels(percentage, total_pixels):
-    return (percentage / 100) * total_pixels
-
-async def get_selected_preview_image(pattern_src_url, default_product_base64, Dim_left, Dim_top, Dim_width, Dim_height):
-    try:
-        # logger.info(f"Calculated Coordinates - x: {tmp_x}, y: {tmp_y}, width: {tmp_width}, height: {tmp_height}")
-        default_product_base64_new = correct_base64_padding(strip_base64_prefix(default_product_base64))
-        cloth_img_data = base64.b64decode(default_product_base64_new)
-        if pattern_src_url.startswith('data:image/jpeg;base64,'):
-            pattern_img_res = correct_base64_padding(pattern_src_url[len('data:image/jpeg;base64,'):])
-            pattern_img_respons = base64.b64decode(pattern_img_res)
-            cloth_img = Image.open(BytesIO(cloth_img_data)).convert("RGBA")
-            pattern_img = Image.open(BytesIO(pattern_img_respons)).convert("RGBA")
-        elif pattern_src_url.startswith('data:image/png;base64,'):
-            pattern_img_res = correct_base64_padding(pattern_src_url[len('data:image/png;base64,'):])
-            pattern_img_respons = base64.b64decode(pattern_img_res)
-            cloth_img = Image.open(BytesIO(cloth_img_data)).convert("RGBA")
-            pattern_img = Image.open(BytesIO(pattern_img_respons)).convert("RGBA")
-        else:
-            pattern_img_response = requests.get(pattern_src_url)
-            pattern_img_response.raise_for_status()
-            cloth_img = Image.open(BytesIO(cloth_img_data)).convert("RGBA")
-            pattern_img = Image.open(BytesIO(pattern_img_response.content)).convert("RGBA")
-        total_pixels = cloth_img.height
-        x = percentage_to_pixels(Dim_left, total_pixels)
-        y = percentage_to_pixels(Dim_top, total_pixels)
-        width = percentage_to_pixels(Dim_width, total_pixels)
-        height = percentage_to_pixels(Dim_height, total_pixels)
-        tmp_x = round(x)
-        tmp_y = round(y)
-        tmp_width = round(width)
-        tmp_height = round(height)
-        logger.info(f"Cloth image size: {cloth_img.size}, Pattern image size: {pattern_img.size}, Cloth image height: {cloth_img.height}")
-        pattern_img = pattern_img.resize((tmp_height, tmp_width))  
-        output_canvas = Image.new("RGBA", (total_pixels, total_pixels), (255, 255, 255, 0))
-        output_canvas.paste(pattern_img, (tmp_x, tmp_y), pattern_img)
-        output_canvas.paste(cloth_img, (0, 0), cloth_img)
-        if (tmp_x < 0 or tmp_y < 0 or 
-            tmp_x + tmp_width > total_pixels or 
-            tmp_y + tmp_height > total_pixels):
-            raise ValueError("Pattern image dimensions exceed canvas bounds")
-        output_image = BytesIO()
-        output_canvas.save(output_image, format="PNG")
-        output_image.seek(0)
-        base64_image = base64.b64encode(output_image.getvalue()).decode('utf-8')
-        base64_url = f"data:image/png;base64,{base64_image}"
-
-        return base64_url
+class ThumbnailBatch:
+    # Cart thumbnails of one bulk request. Orders reference "t_<img_id>" right
+    # away; the images are rendered per product template and uploaded once
+    # every order has been built.
+    def __init__(self):
+        self._groups = {}
+
+    def add(self, pattern_src_url, color_asset, dimensions, img_id, pattern_cache_key=None):
+        thumbnail_img_id = "t_" + img_id
+        self._groups.setdefault((color_asset, tuple(dimensions)), []).append(
+            (pattern_src_url, pattern_cache_key, thumbnail_img_id)
+        )
+        return thumbnail_img_id
+
+    async def upload(self):
+        # Returns the thumbnail ids that could not be rendered or uploaded
+        groups = await asyncio.gather(
+            *[self._upload_group(color_asset, dimensions, entries) for (color_asset, dimensions), entries in self._groups.items()]
+        )
+        self._groups = {}
+        failed = [thumbnail_img_id for group in groups for thumbnail_img_id in group]
+        if failed:
+            logger.error(f"{len(failed)} thumbnails failed: {failed}")
+        return failed
+
+    async def _upload_group(self, color_asset, dimensions, entries):
+        failed = []
+        try:
+            # Product color assets are S3 keys since organizations stopped storing inline images
+            if not color_asset.startswith('data:image'):
+                color_asset = generate_presigned_url(color_asset, "drophouse-skeleton")
+            cloth_bytes = await image_fetcher.fetch(color_asset)
+        except Exception as e:
+            logger.error(f"Error fetching product template for thumbnails: {e}")
+            return [thumbnail_img_id for _, _, thumbnail_img_id in entries]
+
+        template_key = hashlib.sha1(cloth_bytes).hexdigest()
+        chunks = [entries[start:start + THUMBNAIL_BATCH_SIZE] for start in range(0, len(entries), THUMBNAIL_BATCH_SIZE)]
+        uploads = []
+        async for chunk, patterns in image_fetcher.prefetch(chunks, lambda chunk: [(url, cache_key) for url, cache_key, _ in chunk]):
+            rendered = [(entry[2], pattern) for entry, pattern in zip(chunk, patterns) if not isinstance(pattern, Exception)]
+            failed += [entry[2] for entry, pattern in zip(chunk, patterns) if isinstance(pattern, Exception)]
+            if not rendered:
+                continue
+            try:
+                results = await run_in_pool(
+                    render_thumbnail_batch, template_key, cloth_bytes, dimensions, [pattern for _, pattern in rendered]
+                )
+            except Exception as e:
+                logger.error(f"Error generating preview images: {e}")
+                failed += [thumbnail_img_id for thumbnail_img_id, _ in rendered]
+                continue
+            for (thumbnail_img_id, _), (jpeg_bytes, error) in zip(rendered, results):
+                if error:
+                    logger.error(f"Error generating preview image {thumbnail_img_id}: {error}")
+                    failed.append(thumbnail_img_id)
+                else:
+                    # Uploads overlap with rendering the next chunk
+                    upload = asyncio.ensure_future(asyncio.to_thread(uploadImageBytes, jpeg_bytes, thumbnail_img_id, "thumbnails-cart"))
+                    uploads.append((thumbnail_img_id, upload))
 
-    except Exception as e:
-        logger.error(f"Error generating preview image: {e}")
-        return None
+        results = await asyncio.gather(*[upload for _, upload in uploads], return_exceptions=True)
+        for (thumbnail_img_id, _), result in zip(uploads, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error uploading thumbnail {thumbnail_img_id}: {result}")
+                failed.append(thumbnail_img_id)
+        return failed
 
 @bulk_order_router.post("/generate_three_image")
 async def generate_three_image(
@@ -220,7 +269,7 @@ async def regenerate_order(
 ):
     try:
         user_data = request.file
-        tasks = []
+        thumbnails = ThumbnailBatch()
         for idx in range(len(user_data)):              
             order_id = str(uuid.uuid4())
             if 'order_id' in user_data[idx]:
@@ -231,7 +280,9 @@ async def regenerate_order(
             # image_data = user_data[idx]['img_url']
             # base64Data = image_data[len('data:image/jpeg;base64,'):]
             # img_data = f"data:image/png;base64,{base64Data}"
-            img_url = processAndSaveImage(user_data[idx]['img_url'], img_id, "browse-image-v2")
+            # Decoded once, then shared by the upload and the thumbnail
+            image = ImagePayload.from_data_url(user_data[idx]['img_url'])
+            img_url = await asyncio.to_thread(processAndSaveImage, image, img_id, "browse-image-v2")
             organization = await org_db_ops.get_organization_data(org_id)
             if not organization:
                 thumbnail = 'null'
@@ -264,16 +315,12 @@ async def regenerate_order(
                         Dim_top = default_product['dimensions']['top']
                         Dim_width = default_product['dimensions']['width']
                         Dim_height = default_product['dimensions']['height']
-                        thumbnail = await get_selected_preview_image(
-                            pattern_src_url= user_data[idx]['img_url'],
-                            default_product_base64=color_asset,
-                            Dim_left=Dim_left,
-                            Dim_top=Dim_top,
-                            Dim_width=Dim_width,
-                            Dim_height=Dim_height
+                        thumbnail = thumbnails.add(
+                            pattern_src_url=image,
+                            color_asset=color_asset,
+                            dimensions=(Dim_left, Dim_top, Dim_width, Dim_height),
+                            img_id=img_id
                         )
-                        thumbnail_img_id = "t_" + img_id
-                        tasks.append(asyncio.to_thread(processAndSaveImage, thumbnail, thumbnail_img_id, "thumbnails-cart"))
 
 
             order_model = OrderItem(
@@ -319,7 +366,8 @@ async def regenerate_order(
                     user_data[idx]['order_id'] = order_id
                 else:
                     raise HTTPException(status_code=404, detail={'message': "Can't able to create an order", 'currentFrame': getframeinfo(currentframe())})
-        await asyncio.gather(*tasks)
+        # Orders already point at t_<img_id>; those whose thumbnail failed are reset
+        await order_db_ops.clear_thumbnails(await thumbnails.upload())
         return user_data
     except HTTPException as http_ex:
         raise http_ex
@@ -356,7 +404,7 @@ async def make_bulk_order(
             pass
 
         retry = 0
-        tasks = []
+        thumbnails = ThumbnailBatch()
         file_data = request.file
         # retry_limit = int(len(user_data)/2) if int(len(user_data)/2) > min_retry else min_retry
         for idx in range(len(request.file)):
@@ -408,16 +456,13 @@ async def make_bulk_order(
                             Dim_top = default_product['dimensions']['top']
                             Dim_width = default_product['dimensions']['width']
                             Dim_height = default_product['dimensions']['height']
-                            thumbnail = await get_selected_preview_image(
-                                pattern_src_url= generate_presigned_url(imageresponse[1], "browse-image-v2"),
-                                default_product_base64=color_asset,
-                                Dim_left=Dim_left,
-                                Dim_top=Dim_top,
-                                Dim_width=Dim_width,
-                                Dim_height=Dim_height
+                            thumbnail = thumbnails.add(
+                                pattern_src_url=generate_presigned_url(imageresponse[1], "browse-image-v2"),
+                                color_asset=color_asset,
+                                dimensions=(Dim_left, Dim_top, Dim_width, Dim_height),
+                                img_id=imageresponse[1],
+                                pattern_cache_key=browse_image_cache_key(imageresponse[1])
                             )
-                            thumbnail_img_id = "t_" + imageresponse[1]
-                            tasks.append(asyncio.to_thread(processAndSaveImage, thumbnail, thumbnail_img_id, "thumbnails-cart"))
 
 
                 order_model = OrderItem(
@@ -508,16 +553,12 @@ async def make_bulk_order(
                             Dim_top = default_product['dimensions']['top']
                             Dim_width = default_product['dimensions']['width']
                             Dim_height = default_product['dimensions']['height']
-                            thumbnail = await get_selected_preview_image(
-                                pattern_src_url= user_data['toggled'],
-                                default_product_base64=color_asset,
-                                Dim_left=Dim_left,
-                                Dim_top=Dim_top,
-                                Dim_width=Dim_width,
-                                Dim_height=Dim_height
+                            thumbnail = thumbnails.add(
+                                pattern_src_url=user_data['toggled'],
+                                color_asset=color_asset,
+                                dimensions=(Dim_left, Dim_top, Dim_width, Dim_height),
+                                img_id=user_data['img_id']
                             )
-                            thumbnail_img_id = "t_" + user_data['img_id']
-                            tasks.append(asyncio.to_thread(processAndSaveImage, thumbnail, thumbnail_img_id, "thumbnails-cart"))
 
 
                 order_model = OrderItem(
@@ -566,7 +607,8 @@ async def make_bulk_order(
                     else:
                         ag_task_storage[request.task_id]['failed'] = ag_task_storage[request.task_id]['success'] + 1
                         raise HTTPException(status_code=404, detail={'message': "Can't able to create an order", 'currentFrame': getframeinfo(currentframe())})
-        await asyncio.gather(*tasks)
+        # Orders already point at t_<img_id>; those whose thumbnail failed are reset
+        await order_db_ops.clear_thumbnails(await thumbnails.upload())
         ag_task_storage.pop(request.task_id, None)
         return file_data
     except HTTPException as http_ex:
@@ -611,37 +653,3 @@ async def websocket_progress(websocket: WebSocket, task_id: str):
         logger.info(f"WebSocket error: {e}")
     finally:
         await websocket.close()
-
-def process_mask_data(organization, isImgId):
-    if not organization:
-        return None
-
-    if not isImgId:
-        if 'greenmask' in organization and organization['greenmask'] != 'null' and organization['greenmask'] != '':
-            mask_data = organization['greenmask']
-        else:
-            return None
-    else:
-        if organization != None and organization != "":
-            mask_data = organization
-        else:
-            return None
-    
-    if isinstance(mask_data, bytes) and mask_data.startswith(b'data:image'):
-        mask_data = mask_data.split(b',')[1]
-    else:
-        try:
-            if not mask_data or mask_data == None:
-                return None
-
-            mask_data = generate_presigned_url(mask_data, "drophouse-skeleton")
-            response = requests.get(mask_data)
-            if response.status_code == 200:
-                mask_data = base64.b64encode(response.content)
-            else:
-                raise ValueError(f"Error downloading image. Status code: {response.status_code}")
-        except Exception as e:
-            logger.info(f"Error processing mask data: {e}")
-            mask_data = None
-
-    return mask_data
\ No newline at end of file
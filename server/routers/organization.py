@@ -7,15 +7,19 @@ from database.BASE import BaseDatabaseOperation
 from models.OrganizationModel import OrganizationModel
 from aws_utils import generate_presigned_url #, processAndSaveImage
 from database.OrganizationOperation import OrganizationOperation
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from utils.etag import etag_matches
+from utils.image_fetcher import image_fetcher
+from utils.mask_cache import mask_cache
 from typing import Dict, Any
 from bson import ObjectId
 from pydantic import BaseModel
 import httpx
-import base64
+from utils.image_payload import ImagePayload
 import boto3
 import io
-from PIL import Image
 from botocore.exceptions import NoCredentialsError
 from botocore.client import Config
 
@@ -28,13 +32,7 @@ HARD_CODED_PASSWORD = "Drophouse23#"
 
 def processAndSaveImage(image_data: str, img_id: str, s3_bucket_name_: str):
     try:
-        if "," in image_data:
-            image_data = image_data.split(",", 1)[1]
-        else:
-            raise ValueError("Invalid image data")
-
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
+        image = ImagePayload.from_data_url(image_data).open()
 
         # if image.mode == 'RGBA':
         # image = image.convert('RGB')
@@ -77,17 +75,51 @@ def processAndSaveImage(image_data: str, img_id: str, s3_bucket_name_: str):
             },
         )
 
+@org_router.get("/organisation_list")
 @org_router.post("/organisation_list")
 async def organisation_list(
+	request: Request,
+	summary: bool = False,
 	db_ops: BaseDatabaseOperation = Depends(get_db_ops(OrganizationOperation)),
 ):
 	try:
-		result = await db_ops.get()
-		return result;
+		etag = await db_ops.get_list_etag(summary)
+		if etag_matches(request, etag):
+			return Response(status_code=304, headers={"ETag": etag})
+
+		result, etag = await db_ops.get_with_etag(summary)
+		headers = {"ETag": etag, "Cache-Control": "no-cache"} if etag else None
+		return JSONResponse(content=jsonable_encoder(result), headers=headers)
 	except Exception as e:
 		logger.error(f"Error in getting Organization: {str(e)}", exc_info=True)
 		raise HTTPException(status_code=500, detail={'message':"Internal Server Error", 'currentFrame': getframeinfo(currentframe()), 'detail': str(traceback.format_exc())})
 
+class OrgDetailRequest(BaseModel):
+    org_id: str
+
+@org_router.post("/organisation_detail")
+async def organisation_detail(
+    request: Request,
+    request_body: OrgDetailRequest,
+    db_ops: BaseDatabaseOperation = Depends(get_db_ops(OrganizationOperation)),
+):
+    try:
+        etag = await db_ops.get_detail_etag(request_body.org_id)
+        if not etag:
+            raise HTTPException(status_code=404, detail={'message':"No Organisation found", 'currentFrame': getframeinfo(currentframe())})
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        result, etag = await db_ops.get_detail_with_etag(request_body.org_id)
+        if not result:
+            raise HTTPException(status_code=404, detail={'message':"No Organisation found", 'currentFrame': getframeinfo(currentframe())})
+        return JSONResponse(content=jsonable_encoder(result), headers={"ETag": etag, "Cache-Control": "no-cache"})
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        logger.error(f"Error in getting Organization detail: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail={'message':"Internal Server Error", 'currentFrame': getframeinfo(currentframe()), 'detail': str(traceback.format_exc())})
+
 class OrgIdRequest(BaseModel):
     org_id: str
     apparel: str
@@ -95,13 +127,11 @@ class OrgIdRequest(BaseModel):
     img_url: str
 
 async def fetch_image_as_base64(image_url: str) -> str:
-    async with httpx.AsyncClient() as client:
-        response = await client.get(image_url)
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail="Failed to fetch image")
-        image_data = response.content
-        base64_data = base64.b64encode(image_data).decode('utf-8')
-        return f"data:image/jpeg;base64,{base64_data}"
+    try:
+        image_data = await image_fetcher.fetch(image_url)
+    except httpx.HTTPStatusError as error:
+        raise HTTPException(status_code=error.response.status_code, detail="Failed to fetch image")
+    return ImagePayload(image_data).to_data_url()
 
 @org_router.post("/get_org_data")
 async def get_org_data(
@@ -179,6 +209,8 @@ async def create_organisation(
         if org_gm and org_gm.startswith("data:image"):
             processAndSaveImage(org_gm, f"gm_{org_id}", org_bucket_name)
             request.greenmask = f"gm_{org_id}"
+            # Same key as before: drop the decoded copy of the old mask
+            mask_cache.invalidate(request.greenmask)
         elif org_gm and (org_gm.startswith("http://") or org_gm.startswith("https://")):
             request.greenmask = f"gm_{org_id}"
         
@@ -216,6 +248,7 @@ async def create_organisation(
             if product.greenmask and product.greenmask.startswith("data:image"):
                 processAndSaveImage(product.greenmask, f"p_{counter}_{product.name}_greenmask_{org_id}", org_bucket_name)
                 product.greenmask = f"p_{counter}_{product.name}_greenmask_{org_id}"
+                mask_cache.invalidate(product.greenmask)
             elif product.greenmask and (product.greenmask.startswith("http://") or product.greenmask.startswith("https://")):
                 product.greenmask = f"p_{counter}_{product.name}_greenmask_{org_id}"
             
@@ -292,6 +325,8 @@ async def update_organisation(
         if org_gm and org_gm.startswith("data:image"):
             processAndSaveImage(org_gm, f"gm_{org_id}", org_bucket_name)
             request.greenmask = f"gm_{org_id}"
+            # Same key as before: drop the decoded copy of the old mask
+            mask_cache.invalidate(request.greenmask)
         # elif org_gm and (org_gm.startswith("http://") or org_gm.startswith("https://")):
             # request.greenmask = f"gm_{org_id}"
         
@@ -329,6 +364,7 @@ async def update_organisation(
             if product.greenmask and product.greenmask.startswith("data:image"):
                 processAndSaveImage(product.greenmask, f"p_{counter}_{product.name}_greenmask_{org_id}", org_bucket_name)
                 product.greenmask = f"p_{counter}_{product.name}_greenmask_{org_id}"
+                mask_cache.invalidate(product.greenmask)
             # elif product.greenmask and (product.greenmask.startswith("http://") or product.greenmask.startswith("https://")):
                 # product.greenmask = f"p_{counter}_{product.name}_greenmask_{org_id}"
             
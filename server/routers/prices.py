@@ -7,23 +7,35 @@ from db import get_db_ops
 from database.BASE import BaseDatabaseOperation
 from models.PricesModel import PricesModel
 from database.PricesOperations import PricesOperations
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from fastapi.responses import JSONResponse
+from utils.etag import etag_matches
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 prices_router = APIRouter()
 
+@prices_router.get("/get_prices")
 @prices_router.post("/get_prices")
 async def get_prices(
+    request: Request,
     # user_id: str = Depends(verify_id_token),
 	db_ops: BaseDatabaseOperation = Depends(get_db_ops(PricesOperations)),
 ):
     try:
         # if not user_id:
             # raise HTTPException(status_code=401, detail={'message':"User ID is required.", 'currentFrame': getframeinfo(currentframe())})
-        result = await db_ops.get()
-        return result;
+        etag = db_ops.cached_etag()
+        if etag and etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        result, etag = await db_ops.get_with_etag()
+        if not etag:
+            return JSONResponse(content=result)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return JSONResponse(content=result, headers={"ETag": etag, "Cache-Control": "no-cache"})
     except Exception as e:
         logger.error(f"Error in get prices: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail={'message':"Internal Server Error", 'currentFrame': getframeinfo(currentframe()), 'detail': str(traceback.format_exc())})
@@ -0,0 +1,219 @@
+import argparse
+import logging
+import platform
+import tempfile
+import resource
+import tracemalloc
+import json
+import sys
+import os
+import time
+
+import numpy as np
+import cv2
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.mask_pipeline import (
+    recolor_greenmask,
+    decode_background,
+    encode_png,
+    _clean_region,
+    GreenMask,
+    BACKGROUND_SIZE,
+)
+from utils.thumbnail_compositor import (
+    render_thumbnail_batch,
+    ThumbnailTemplate,
+    encode_jpeg,
+)
+from tests.image_fixtures import (
+    legacy_recolor,
+    legacy_thumbnail,
+    per_image_apply,
+    binary_mask,
+    synthetic_mask,
+    synthetic_photo,
+)
+
+# Offline benchmark suite for the image pipeline, on synthetic masks and images.
+# Each stage is timed on its own (latency percentiles, throughput), then run
+# once more under tracemalloc for peak memory. That the vectorized paths match
+# the code they replaced pixel for pixel is checked by server/tests.
+#   python scripts/benchmark_image_pipeline.py [--repeat 20] [--stages decode recolor ...]
+#       [--output report.json] [--compare previous_report.json]
+# Reports from the same machine can be compared stage by stage with --compare.
+
+REPORT_VERSION = 2
+THUMBNAIL_DIMENSIONS = (25, 20, 50, 50)
+
+
+def load_pdf_renderer():
+    # generate_vector_ai pulls in reportlab and fastapi; the stage is skipped without them
+    from utils.generate_vector_ai import render_folder_pdf
+    return render_folder_pdf
+
+
+def build_stages(batch_size, mask_size, source_size, pdf_pages):
+    mask = synthetic_mask(mask_size)
+    green_mask = GreenMask(binary_mask(), "benchmark")
+    prepared = green_mask.prepared(recolor=True)
+    source_jpeg = synthetic_photo(source_size)
+    background = decode_background(source_jpeg)
+    masked = prepared.apply(background)
+    cloth_png = encode_png(per_image_apply(prepared.shape, background))
+    pattern_jpeg = synthetic_photo(source_size // 2, seed=5)
+    patterns = [synthetic_photo(source_size // 2, seed) for seed in range(batch_size)]
+    template = ThumbnailTemplate(cloth_png, THUMBNAIL_DIMENSIONS)
+    pixels = BACKGROUND_SIZE[0] * BACKGROUND_SIZE[1]
+
+    def pdf_page():
+        render_folder_pdf = load_pdf_renderer()
+        workdir = tempfile.mkdtemp(prefix="benchmark_pdf_")
+        folder = os.path.join(workdir, "M")
+        os.makedirs(folder)
+        for page in range(pdf_pages):
+            with open(os.path.join(folder, f"M_student_{page}.png"), "wb") as image_file:
+                image_file.write(cloth_png)
+        pdf_file = os.path.join(workdir, "M.pdf")
+        return (lambda: render_folder_pdf(folder, pdf_file)), pdf_pages, pixels * pdf_pages
+
+    # name -> (setup returning (callable, items per call, pixels per call), baseline stage or None)
+    return {
+        "decode": (lambda: ((lambda: decode_background(source_jpeg)), 1, pixels), None),
+        "recolor": (lambda: ((lambda: recolor_greenmask(mask)), 1, mask.shape[0] * mask.shape[1]), None),
+        "recolor_legacy": (lambda: ((lambda: legacy_recolor(mask)), 1, mask.shape[0] * mask.shape[1]), "recolor"),
+        "prepare_mask": (lambda: ((lambda: GreenMask(green_mask.pixels, "benchmark").prepared(recolor=True)), 1, pixels), None),
+        "composite": (lambda: ((lambda: prepared.apply(background)), 1, pixels), None),
+        "composite_legacy": (lambda: ((lambda: per_image_apply(prepared.shape, background)), 1, pixels), "composite"),
+        "morphology": (lambda: ((lambda: _clean_region(prepared.green)), 1, pixels), None),
+        "encode": (lambda: ((lambda: encode_png(masked)), 1, pixels), None),
+        "thumbnail": (lambda: ((lambda: encode_jpeg(template.render(pattern_jpeg))), 1, pixels), None),
+        "thumbnail_batch": (lambda: ((lambda: render_thumbnail_batch("benchmark", cloth_png, THUMBNAIL_DIMENSIONS, patterns)),
+                                     batch_size, pixels * batch_size), None),
+        "thumbnail_legacy": (lambda: ((lambda: encode_jpeg(legacy_thumbnail(cloth_png, pattern_jpeg, THUMBNAIL_DIMENSIONS))),
+                                      1, pixels), "thumbnail"),
+        "pdf_page": (pdf_page, None),
+    }
+
+
+def max_rss_bytes():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def measure(fn, items, pixels, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    # One extra run under tracemalloc, kept out of the timings
+    rss_before = max_rss_bytes()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    samples = np.array(samples)
+    mean_ms = float(samples.mean())
+    return {
+        "runs": repeat,
+        "items_per_call": items,
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "p99_ms": round(float(np.percentile(samples, 99)), 3),
+        "min_ms": round(float(samples.min()), 3),
+        "mean_ms": round(mean_ms, 3),
+        "items_per_second": round(items * 1000 / mean_ms, 1),
+        "megapixels_per_second": round(pixels / 1000 / mean_ms, 1),
+        "peak_traced_bytes": peak,
+        "max_rss_growth_bytes": max_rss_bytes() - rss_before,
+    }
+
+
+def run(stage_names, repeat, legacy_repeat, warmup, batch_size, mask_size, source_size, pdf_pages):
+    stages = build_stages(batch_size, mask_size, source_size, pdf_pages)
+    results = {}
+    for name in stage_names or stages:
+        setup, baseline_of = stages[name]
+        try:
+            fn, items, pixels = setup()
+        except ImportError as error:
+            results[name] = {"skipped": f"missing dependency: {error}"}
+            continue
+        runs = legacy_repeat if baseline_of else repeat
+        results[name] = measure(fn, items, pixels, runs, 0 if baseline_of else warmup)
+        if baseline_of:
+            results[name]["baseline_of"] = baseline_of
+
+    return {
+        "version": REPORT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pillow": Image.__version__,
+            "opencv": cv2.__version__,
+        },
+        "parameters": {
+            "repeat": repeat,
+            "legacy_repeat": legacy_repeat,
+            "warmup": warmup,
+            "batch_size": batch_size,
+            "mask_size": mask_size,
+            "source_size": source_size,
+            "pdf_pages": pdf_pages,
+        },
+        "stages": results,
+        "max_rss_bytes": max_rss_bytes(),
+    }
+
+
+def print_report(report, previous=None):
+    previous_stages = (previous or {}).get("stages", {})
+    for name, stage in report["stages"].items():
+        if "skipped" in stage:
+            print(f"{name:<18} skipped ({stage['skipped']})")
+            continue
+        line = (f"{name:<18} p50 {stage['p50_ms']:>9.2f} ms  p95 {stage['p95_ms']:>9.2f} ms  p99 {stage['p99_ms']:>9.2f} ms"
+                f"  {stage['items_per_second']:>9.1f} img/s  peak {stage['peak_traced_bytes'] / 2**20:>7.1f} MiB")
+        before = previous_stages.get(name)
+        if before and "p50_ms" in before:
+            line += f"  p50 {(stage['p50_ms'] / before['p50_ms'] - 1) * 100:+.1f}%"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stages", nargs="+")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--legacy-repeat", type=int, default=2)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--mask-size", type=int, default=BACKGROUND_SIZE[0])
+    parser.add_argument("--source-size", type=int, default=1024)
+    parser.add_argument("--pdf-pages", type=int, default=8)
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    # Per-call info logs from the code under test would drown the report
+    logging.disable(logging.INFO)
+    report = run(args.stages, args.repeat, args.legacy_repeat, args.warmup, args.batch_size,
+                 args.mask_size, args.source_size, args.pdf_pages)
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+    print_report(report, previous)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=2)
@@ -17,6 +17,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from db import get_db_ops, connect_to_mongo, close_mongo_connection, get_database
 from models.OrganizationModel import OrganizationModel
 from database.BASE import BaseDatabaseOperation
+from database.OrganizationOperation import stamp_updated_at
 # from aws_utils import processAndSaveImage
 # from utils.printful_util import processAndSaveImage
 
@@ -106,8 +107,8 @@ class OrganizationMigration(BaseDatabaseOperation):
                     if 'asset_back' in product and isinstance(product['asset_back'], bytes) and product['asset_back'].startswith(b'data:image'):
                         product['asset_back'] = product['asset_back'].decode('utf-8')
                     if 'asset_back' in product and product['asset_back'] and product['asset_back'].startswith("data:image"):
-                        processAndSaveImage(product['asset_back'], f"lp_{product['name']}_{org_id}", s3_bucket_name)
-                        product['asset_back'] = f"lp_{product['name']}_{org_id}"
+                        processAndSaveImage(product['asset_back'], f"lp_ab_{product['name']}_{org_id}", s3_bucket_name)
+                        product['asset_back'] = f"lp_ab_{product['name']}_{org_id}"
 
             # Process product details
             if 'products' in org:
@@ -119,6 +120,13 @@ class OrganizationMigration(BaseDatabaseOperation):
                         processAndSaveImage(product['mask'], f"p_{product['name']}_mask_{org_id}", s3_bucket_name)
                         product['mask'] = f"p_{product['name']}_mask_{org_id}"
                     
+                    # Green mask
+                    if 'greenmask' in product and isinstance(product['greenmask'], bytes) and product['greenmask'].startswith(b'data:image'):
+                        product['greenmask'] = product['greenmask'].decode('utf-8')
+                    if product.get('greenmask') and product['greenmask'].startswith("data:image"):
+                        processAndSaveImage(product['greenmask'], f"p_{product['name']}_greenmask_{org_id}", s3_bucket_name)
+                        product['greenmask'] = f"p_{product['name']}_greenmask_{org_id}"
+
                     # Default Product Image
                     if 'defaultProduct' in product and isinstance(product['defaultProduct'], bytes) and product['defaultProduct'].startswith(b'data:image'):
                         product['defaultProduct'] = product['defaultProduct'].decode('utf-8')
@@ -145,7 +153,7 @@ class OrganizationMigration(BaseDatabaseOperation):
 
             # Convert to Pydantic model
             org_model = OrganizationModel(**org)
-            org_data = org_model.model_dump()
+            org_data = stamp_updated_at(org_model.model_dump())
 
             # Update the organization in the database
             result = await self.db.organizations.update_one(
@@ -0,0 +1,88 @@
+import logging
+import asyncio
+import json
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import connect_to_mongo, close_mongo_connection, get_database
+from database.BASE import BaseDatabaseOperation
+from utils.org_assets import find_inline_assets
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Reports organization image fields that still hold inline base64/binary data
+# instead of an S3 key. Fix the reported orgs with organisation_base64_bucketMigrate.py.
+#   python scripts/organisation_inline_blob_report.py [--json]
+# Exits with status 1 when any inline blob is found.
+class OrganizationBlobReport(BaseDatabaseOperation):
+    def __init__(self, db):
+        super().__init__(db)
+
+    async def create(self):
+        pass
+
+    async def update(self):
+        pass
+
+    async def remove(self):
+        pass
+
+    async def get(self):
+        pass
+
+    async def start_report(self):
+        doc_sizes = {}
+        async for doc in self.db.organizations.aggregate([
+            {'$project': {'_id': 0, 'org_id': 1, 'doc_bytes': {'$bsonSize': '$$ROOT'}}}
+        ]):
+            doc_sizes[doc.get('org_id')] = doc['doc_bytes']
+
+        report = []
+        # This is the one reader that has to pull the blobs, so walk the collection a document at a time
+        async for org in self.db.organizations.find({}, {'_id': 0}):
+            inline_assets = find_inline_assets(org)
+            if not inline_assets:
+                continue
+            report.append({
+                'org_id': org.get('org_id'),
+                'name': org.get('name'),
+                'doc_bytes': doc_sizes.get(org.get('org_id')),
+                'inline_bytes': sum(size for _, size in inline_assets),
+                'fields': [{'path': path, 'bytes': size} for path, size in inline_assets],
+            })
+
+        report.sort(key=lambda entry: entry['inline_bytes'], reverse=True)
+        return {
+            'organizations_scanned': len(doc_sizes),
+            'organizations_with_blobs': len(report),
+            'total_inline_bytes': sum(entry['inline_bytes'] for entry in report),
+            'organizations': report,
+        }
+
+def print_report(report):
+    print(f"Organizations scanned : {report['organizations_scanned']}")
+    print(f"With inline blobs     : {report['organizations_with_blobs']}")
+    print(f"Total inline bytes    : {report['total_inline_bytes']}")
+    for entry in report['organizations']:
+        print(f"\n{entry['org_id']} ({entry['name']}) document={entry['doc_bytes']}B inline={entry['inline_bytes']}B")
+        for field in entry['fields']:
+            print(f"    {field['path']:<60} {field['bytes']:>10}B")
+
+async def main(as_json: bool):
+    await connect_to_mongo()
+    try:
+        report = await OrganizationBlobReport(get_database()).start_report()
+    finally:
+        await close_mongo_connection()
+
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return report
+
+if __name__ == "__main__":
+    result = asyncio.run(main("--json" in sys.argv[1:]))
+    sys.exit(1 if result['organizations_with_blobs'] else 0)
@@ -0,0 +1,110 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from utils.mask_pipeline import (
+    composite_greenmask,
+    remove_green_background,
+    GREEN,
+    IGNORE_COLORS,
+    BACKGROUND_SIZE,
+)
+from utils.thumbnail_compositor import percentage_to_pixels
+
+# Synthetic inputs and the implementations the image pipeline replaced, shared
+# by the tests (which check the new code against them pixel for pixel) and by
+# the legacy stages of scripts/benchmark_image_pipeline.py
+
+
+def legacy_recolor(mask):
+    # Per-pixel loop applyMask_and_removeBackground used before recolor_greenmask
+    target_color = (82, 178, 38, 255)
+    ignore_colors = [(255,255,255,255), (255, 255, 255, 0), (0, 0, 0, 0)]
+    shape_image = Image.fromarray(mask)
+    data = shape_image.getdata()
+    new_data = []
+    for idx, pixel in enumerate(data):
+        if pixel[:4] != target_color and pixel[:4] not in ignore_colors:
+            new_data.append(target_color)
+        else:
+            new_data.append(pixel)
+    shape_image.putdata(new_data)
+    return np.asarray(shape_image)
+
+
+def synthetic_mask(size, seed=7):
+    rng = np.random.default_rng(seed)
+    # Mask colors plus near misses that must still be recolored
+    palette = np.array(
+        [GREEN] + IGNORE_COLORS + [(82, 178, 38, 254), (255, 255, 254, 255), (0, 0, 0, 255), (40, 40, 40, 128)],
+        dtype=np.uint8,
+    )
+    mask = palette[rng.integers(0, len(palette), size=(size, size))]
+    noise = rng.random((size, size)) < 0.05
+    mask[noise] = rng.integers(0, 256, size=(int(noise.sum()), 4), dtype=np.uint8)
+    return mask
+
+
+def synthetic_background(seed=11):
+    rng = np.random.default_rng(seed)
+    background = rng.integers(0, 256, size=BACKGROUND_SIZE + (4,), dtype=np.uint8)
+    background[..., 3] = 255
+    # A few exact GREEN pixels exercise the fallback that redoes the morphology
+    background[:4, :4] = GREEN
+    return background
+
+
+def synthetic_photo(size, seed=3, image_format="JPEG"):
+    # Smooth gradients plus noise, closer to generated artwork than pure noise
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    photo = np.stack([x * 255, y * 255, (1 - x) * y * 255], axis=-1)
+    photo += rng.normal(0, 12, photo.shape)
+    image = Image.fromarray(np.clip(photo, 0, 255).astype(np.uint8))
+    buffered = BytesIO()
+    image.save(buffered, format=image_format, quality=90)
+    return buffered.getvalue()
+
+
+def compose_preview_png(cloth_bytes, pattern_bytes, dim_left, dim_top, dim_width, dim_height):
+    # Pastes the pattern onto a transparent square canvas at the product's print
+    # area (given in percent of the cloth height), then the cloth on top of it.
+    # This is what thumbnails were rendered with before ThumbnailTemplate
+    cloth_img = Image.open(BytesIO(cloth_bytes)).convert("RGBA")
+    pattern_img = Image.open(BytesIO(pattern_bytes)).convert("RGBA")
+    total_pixels = cloth_img.height
+    tmp_x = round(percentage_to_pixels(dim_left, total_pixels))
+    tmp_y = round(percentage_to_pixels(dim_top, total_pixels))
+    tmp_width = round(percentage_to_pixels(dim_width, total_pixels))
+    tmp_height = round(percentage_to_pixels(dim_height, total_pixels))
+    pattern_img = pattern_img.resize((tmp_height, tmp_width))
+    output_canvas = Image.new("RGBA", (total_pixels, total_pixels), (255, 255, 255, 0))
+    output_canvas.paste(pattern_img, (tmp_x, tmp_y), pattern_img)
+    output_canvas.paste(cloth_img, (0, 0), cloth_img)
+    if (tmp_x < 0 or tmp_y < 0 or
+        tmp_x + tmp_width > total_pixels or
+        tmp_y + tmp_height > total_pixels):
+        raise ValueError("Pattern image dimensions exceed canvas bounds")
+    output_image = BytesIO()
+    output_canvas.save(output_image, format="PNG")
+    return output_image.getvalue()
+
+
+def legacy_thumbnail(cloth_png, pattern_jpeg, dimensions):
+    # compose_preview_png, then the flatten on white processAndSaveImage did before uploading
+    image = Image.open(BytesIO(compose_preview_png(cloth_png, pattern_jpeg, *dimensions)))
+    background = Image.new("RGB", image.size, (255, 255, 255))
+    background.paste(image, mask=image.split()[3])
+    return np.asarray(background)
+
+
+def per_image_apply(shape, background):
+    return remove_green_background(composite_greenmask(shape, background))
+
+
+def binary_mask():
+    # Masks stored for orgs are fully opaque or fully transparent
+    mask = synthetic_mask(BACKGROUND_SIZE[0])
+    mask[..., 3] = np.where(mask[..., 3] == 255, 255, 0)
+    return mask
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from utils.mask_pipeline import recolor_greenmask, encode_png, GreenMask, BACKGROUND_SIZE
+from utils.thumbnail_compositor import ThumbnailTemplate
+from tests.image_fixtures import (
+    legacy_recolor,
+    legacy_thumbnail,
+    per_image_apply,
+    binary_mask,
+    synthetic_mask,
+    synthetic_background,
+    synthetic_photo,
+)
+
+
+@pytest.mark.parametrize("size", [64, BACKGROUND_SIZE[0]])
+def test_recolor_matches_per_pixel_loop(size):
+    mask = synthetic_mask(size)
+    assert np.array_equal(recolor_greenmask(mask), legacy_recolor(mask))
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_prepared_mask_matches_per_image_path(seed):
+    prepared = GreenMask(binary_mask(), "test").prepared(recolor=True)
+    background = synthetic_background(seed)
+    if seed % 2:
+        # Without exact GREEN pixels the morphology is not redone
+        background[:4, :4] = (0, 0, 0, 255)
+    assert np.array_equal(prepared.apply(background), per_image_apply(prepared.shape, background))
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG"])
+# Print areas inside the canvas and clipped by it
+@pytest.mark.parametrize("dimensions", [(25, 20, 50, 50), (10, 60, 45, 30)])
+def test_thumbnail_template_matches_compose_preview_png(image_format, dimensions):
+    prepared = GreenMask(binary_mask(), "test").prepared(recolor=True)
+    cloth_png = encode_png(per_image_apply(prepared.shape, synthetic_background()))
+    pattern = synthetic_photo(256, 5, image_format)
+    assert np.array_equal(ThumbnailTemplate(cloth_png, dimensions).render(pattern),
+                          legacy_thumbnail(cloth_png, pattern, dimensions))
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+import threading
+import logging
+import hashlib
+import asyncio
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DIGEST_HEADER_BYTES = 65
+
+
+class DiskLRUCache:
+    # Content cache on the Fly volume. Each entry is one file named after the
+    # sha1 of its key, starting with the sha256 of the content so corrupt or
+    # truncated files are dropped instead of served. Least recently used
+    # entries are evicted once the directory grows past max_bytes.
+    def __init__(self, directory: str, max_bytes: int, name: str):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.name = name
+        self.enabled = max_bytes > 0
+        self._entries = None
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.corrupt = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _load_index(self):
+        # Rebuilds the LRU order from file modification times (touched on every hit)
+        if self._entries is not None:
+            return
+        entries = OrderedDict()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".tmp"):
+                    os.remove(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+            for _, path, size in sorted(files):
+                entries[path] = size
+        except OSError as error:
+            logger.warning(f"{self.name} cache disabled, {self.directory} is not usable: {error}")
+            self.enabled = False
+        self._entries = entries
+        self.size = sum(entries.values())
+
+    def get_sync(self, key):
+        # The lock only covers the index; reading and verifying the file runs
+        # outside it, and writers replace files atomically
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        with self._lock:
+            self._load_index()
+            if path not in self._entries:
+                self.misses += 1
+                return None
+        try:
+            with open(path, "rb") as cache_file:
+                inode = os.fstat(cache_file.fileno()).st_ino
+                digest = cache_file.read(DIGEST_HEADER_BYTES)[:-1].decode("ascii")
+                content = cache_file.read()
+        except FileNotFoundError:
+            # Evicted since the lookup
+            with self._lock:
+                self.misses += 1
+            return None
+        except (OSError, UnicodeDecodeError):
+            content, digest, inode = None, None, None
+        if content is None or hashlib.sha256(content).hexdigest() != digest:
+            logger.warning(f"{self.name} cache entry for {key} failed its integrity check, dropping it")
+            with self._lock:
+                self.corrupt += 1
+                self.misses += 1
+                # Unless a writer has replaced it with a good copy meanwhile
+                if inode is None or self._inode(path) == inode:
+                    self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+            self.hits += 1
+        return content
+
+    def put_sync(self, key, content):
+        if not self.enabled or len(content) + DIGEST_HEADER_BYTES > self.max_bytes:
+            return
+        with self._lock:
+            self._load_index()
+        if not self.enabled:
+            return
+        path = self._path(key)
+        # Written and hashed outside the lock; the rename publishes it whole
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as cache_file:
+                cache_file.write(hashlib.sha256(content).hexdigest().encode("ascii") + b"\n")
+                cache_file.write(content)
+            with self._lock:
+                os.replace(temp_path, path)
+                self.size += len(content) + DIGEST_HEADER_BYTES - self._entries.pop(path, 0)
+                self._entries[path] = len(content) + DIGEST_HEADER_BYTES
+                self.writes += 1
+                while self.size > self.max_bytes and self._entries:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+        except OSError as error:
+            logger.warning(f"Could not write {self.name} cache entry for {key}: {error}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _inode(self, path):
+        try:
+            return os.stat(path).st_ino
+        except OSError:
+            return None
+
+    def _remove(self, path):
+        self.size -= self._entries.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def get(self, key):
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self.get_sync, key)
+
+    async def put(self, key, content):
+        if self.enabled:
+            await asyncio.to_thread(self.put_sync, key, content)
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "directory": self.directory,
+            "entries": len(self._entries or ()),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "corrupt": self.corrupt,
+        }
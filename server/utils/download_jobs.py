@@ -0,0 +1,292 @@
+from aws_utils import uploadArtifactFile, generate_artifact_url
+from utils.job_workspace import JobWorkspace, JOBS_DIR, JOB_WORKSPACE_MAX_AGE
+from utils.zip_stream import stream_zip
+import aiofiles
+import logging
+import asyncio
+import json
+import time
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# When set, finished archives are uploaded here and fetched through a presigned
+# URL; otherwise they are served from the job workspace
+DOWNLOAD_ARTIFACT_BUCKET = os.environ.get("DOWNLOAD_ARTIFACT_BUCKET")
+DOWNLOAD_ARTIFACT_URL_EXPIRY = int(os.environ.get("DOWNLOAD_ARTIFACT_URL_EXPIRY", 3600))
+# Finished jobs (and their archives) are forgotten after this many seconds
+DOWNLOAD_JOB_TTL = int(os.environ.get("DOWNLOAD_JOB_TTL", JOB_WORKSPACE_MAX_AGE))
+# Jobs interrupted by a restart continue from their checkpoint on startup
+DOWNLOAD_JOB_AUTO_RESUME = os.environ.get("DOWNLOAD_JOB_AUTO_RESUME", "1") == "1"
+
+CHECKPOINT_FILE = "checkpoint.jsonl"
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+FINISHED_STATES = {COMPLETED, FAILED}
+
+
+class DownloadJobError(Exception):
+    # A job that cannot run for a reason worth showing to the client
+    pass
+
+
+class JobCheckpoint:
+    # Append-only record of a job in its workspace: a header with what the job
+    # was asked to do (repeated by each resumed run), one line per finished
+    # file, and a final line once the archive is done or the run failed. A
+    # line torn by a crash is ignored when reading it back.
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.path = workspace.path(CHECKPOINT_FILE)
+        self.params = {}
+        self.done = {}
+        self.result = None
+        self.failed = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path) as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "params" in record:
+                    # A new run starts; how earlier runs ended no longer applies
+                    self.params = record["params"]
+                    self.result = None
+                    self.failed = None
+                elif "done" in record:
+                    self.done[record["done"]] = record["path"]
+                elif "result" in record:
+                    self.result = record["result"]
+                elif "failed" in record:
+                    self.failed = record["failed"]
+        return self
+
+    def completed_files(self):
+        # {name: absolute path} of finished files that are still on disk
+        done = {}
+        for name, relative_path in self.done.items():
+            path = os.path.join(self.workspace.files, relative_path)
+            if os.path.isfile(path):
+                done[name] = path
+        return done
+
+    def _append(self, record):
+        with open(self.path, "a") as checkpoint_file:
+            checkpoint_file.write(json.dumps(record) + "\n")
+
+    def start(self, params):
+        # A fresh run replaces the checkpoint; a resumed one keeps what is done
+        self.params = params
+        self.result = None
+        self.failed = None
+        if not os.path.exists(self.path) or not self.done:
+            with open(self.path, "w") as checkpoint_file:
+                checkpoint_file.write(json.dumps({"params": params}) + "\n")
+        else:
+            self._append({"params": params})
+
+    def record(self, name, path):
+        relative_path = os.path.relpath(path, self.workspace.files)
+        self.done[name] = relative_path
+        self._append({"done": name, "path": relative_path})
+
+    def finish(self, result):
+        self.result = result
+        self._append({"result": result})
+
+    def fail(self, error):
+        # Failed runs are only resumed on request, never on startup
+        self.failed = error
+        self._append({"failed": error})
+
+
+class DownloadJob:
+    # state is what progress websockets and the status endpoint report; the
+    # pipeline updates its counters in place. params is what run() needs to
+    # redo the job after a restart.
+    def __init__(self, job_id, total, filename, params=None, resume=False):
+        self.workspace = JobWorkspace(job_id)
+        self.checkpoint = JobCheckpoint(self.workspace)
+        self.job_id = job_id
+        self.filename = filename
+        self.params = {**(params or {}), "total": total, "filename": filename}
+        self.resume = resume
+        self.state = {
+            "job_id": job_id,
+            "status": QUEUED,
+            "success": 0,
+            "failed": 0,
+            "progress": 0,
+            "total": total,
+            "error": None,
+        }
+        self.artifact_path = None
+        self.artifact_key = None
+        self.finished_at = None
+        self.task = None
+
+    @property
+    def status(self):
+        return self.state["status"]
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def expired(self, now):
+        return self.finished_at is not None and now - self.finished_at > DOWNLOAD_JOB_TTL
+
+
+async def write_zip(entries, zip_path):
+    # Same archive as the streamed download, written to disk as entries arrive
+    async with aiofiles.open(zip_path, "wb") as zip_file:
+        async for chunk in stream_zip(entries):
+            await zip_file.write(chunk)
+    return zip_path
+
+
+async def store_artifact(job, zip_path):
+    # Keeps the archive in the workspace, or moves it to S3 when a bucket is
+    # configured. The rest of the workspace (e.g. the EPS files previews are
+    # rendered from) stays until the job is pruned.
+    if not DOWNLOAD_ARTIFACT_BUCKET:
+        job.artifact_path = zip_path
+        return
+    key = f"downloads/{job.job_id}/{job.filename}"
+    await asyncio.to_thread(uploadArtifactFile, zip_path, key, DOWNLOAD_ARTIFACT_BUCKET, "application/zip")
+    job.artifact_key = key
+    await asyncio.to_thread(os.remove, zip_path)
+
+
+def artifact_url(job):
+    return generate_artifact_url(job.artifact_key, DOWNLOAD_ARTIFACT_BUCKET, job.filename, DOWNLOAD_ARTIFACT_URL_EXPIRY)
+
+
+class DownloadJobRegistry:
+    def __init__(self):
+        self.jobs = {}
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def progress(self, job_id):
+        return self.jobs[job_id].state
+
+    def submit(self, job, run):
+        # run(job) does the work in the background; its outcome lands in job.state
+        self.prune()
+        current = self.jobs.get(job.job_id)
+        if current is not None and not current.finished:
+            raise DownloadJobError(f"Job {job.job_id} is already running")
+        self.jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._run(job, run))
+        return job
+
+    async def _run(self, job, run):
+        job.state["status"] = RUNNING
+        try:
+            if job.resume:
+                await asyncio.to_thread(job.workspace.open)
+            else:
+                await asyncio.to_thread(job.workspace.create)
+            await asyncio.to_thread(job.checkpoint.start, job.params)
+            await run(job)
+            if job.artifact_path or job.artifact_key:
+                result = {"artifact_path": job.artifact_path, "artifact_key": job.artifact_key}
+                await asyncio.to_thread(job.checkpoint.finish, result)
+            job.state["status"] = COMPLETED
+        except asyncio.CancelledError:
+            # Shutdown: the workspace and its checkpoint stay for the next start
+            job.state.update(status=FAILED, error="Job interrupted")
+            raise
+        except DownloadJobError as error:
+            job.state.update(status=FAILED, error=str(error))
+            await asyncio.to_thread(job.workspace.cleanup)
+        except Exception as error:
+            # Kept so the job can be resumed on request; stale workspaces are removed at startup
+            logger.error(f"Download job {job.job_id} failed: {error}", exc_info=True)
+            job.state.update(status=FAILED, error="Internal Server Error")
+            try:
+                await asyncio.to_thread(job.checkpoint.fail, str(error))
+            except OSError as checkpoint_error:
+                logger.error(f"Could not record failure of download job {job.job_id}: {checkpoint_error}")
+        finally:
+            job.finished_at = time.time()
+
+    def restore(self, run):
+        # Startup: jobs whose archive is on disk or in S3 can be fetched again, failed
+        # ones are listed as failed, and interrupted ones continue from their
+        # checkpoint through run(job)
+        if not os.path.isdir(JOBS_DIR):
+            return []
+        resumed = []
+        for entry in os.scandir(JOBS_DIR):
+            if entry.name in self.jobs:
+                continue
+            try:
+                job = self.resumable(entry.name)
+            except ValueError:
+                continue
+            if job is None:
+                continue
+            checkpoint = job.checkpoint
+            artifact_path = (checkpoint.result or {}).get("artifact_path")
+            artifact_key = (checkpoint.result or {}).get("artifact_key")
+            if artifact_key:
+                job.artifact_key = artifact_key
+                job.state["status"] = COMPLETED
+                job.finished_at = os.path.getmtime(checkpoint.path)
+                self.jobs[job.job_id] = job
+            elif artifact_path:
+                if os.path.exists(artifact_path):
+                    job.artifact_path = artifact_path
+                    job.state["status"] = COMPLETED
+                    job.finished_at = os.path.getmtime(artifact_path)
+                    self.jobs[job.job_id] = job
+            elif checkpoint.failed is not None:
+                job.state.update(status=FAILED, error="Internal Server Error")
+                job.finished_at = os.path.getmtime(checkpoint.path)
+                self.jobs[job.job_id] = job
+            elif DOWNLOAD_JOB_AUTO_RESUME:
+                logger.info(f"Resuming download job {job.job_id} ({len(checkpoint.done)} files done)")
+                self.submit(job, run)
+                resumed.append(job)
+        return resumed
+
+    def resumable(self, job_id):
+        # A new job that continues job_id from its checkpoint, or None without one
+        checkpoint = JobCheckpoint(JobWorkspace(job_id)).load()
+        params = checkpoint.params
+        if not params:
+            return None
+        job = DownloadJob(job_id, params.get("total", 0), params.get("filename", "archive.zip"), params, resume=True)
+        job.checkpoint = checkpoint
+        return job
+
+    def prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.expired(now):
+                del self.jobs[job_id]
+                job.workspace.cleanup()
+
+    async def cancel_all(self):
+        tasks = [job.task for job in self.jobs.values() if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+download_jobs = DownloadJobRegistry()
+
+
+async def cancel_download_jobs():
+    await download_jobs.cancel_all()
@@ -2,18 +2,24 @@ from inspect import currentframe, getframeinfo
 from reportlab.lib.utils import ImageReader
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
-from fastapi import HTTPException, BackgroundTasks
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
+from utils.process_pool import run_in_pool
+from utils.vectorizer_client import vectorizer_client
+from utils.disk_cache import DiskLRUCache
+from utils.zip_stream import stream_zip
 import traceback
 import requests
 import aiofiles
 import logging
+import threading
 import asyncio
-import shutil
-import base64
 import httpx
+import math
 import os
 
 logging.basicConfig(level=logging.INFO)
@@ -21,96 +27,111 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 VECTORIZER_MODE = os.environ.get("VECTORIZER_MODE")
-VECTORIZER_SECRET = os.environ.get("VECTORIZER_SECRET")
-VECTORIZER_TOKEN = os.environ.get("VECTORIZER_PRIVATE_TOKEN")
 
 if VECTORIZER_MODE == 'prod':
     VECTORIZER_MODE = 'production'
 
-zip_folder = "/mnt/data/student_module_zip_download"
-zip_folder1 = "/mnt/data/student_module_zip_download1"
-output_folder = "/mnt/data/student_module_zip_download/zip"
-output_folder1 = "/mnt/data/student_module_zip_download1/zip"
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
-if not os.path.exists(output_folder1):
-    os.makedirs(output_folder1)
-
-def convert_eps_to_base64(eps_path):
+# Vectorized EPS files, so downloads repeated for the same orders are not paid for twice
+VECTOR_CACHE_DIR = os.environ.get("VECTOR_CACHE_DIR", "/mnt/data/vector_cache")
+VECTOR_CACHE_MAX_BYTES = int(os.environ.get("VECTOR_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+vector_cache = DiskLRUCache(VECTOR_CACHE_DIR, VECTOR_CACHE_MAX_BYTES, "vector")
+
+# Pages show each image at one point per pixel, shrunk to fit the letter page.
+# Images wider than the page (a 4800px print lands at ~565 DPI) are downscaled
+# to this resolution in the pool worker before they are embedded
+PDF_TARGET_DPI = int(os.environ.get("PDF_TARGET_DPI", 300))
+
+# EPS previews are rasterized by Ghostscript, which runs as its own process,
+# so a few threads keep several going without tying up the event loop. Each
+# preview is kept as a PNG next to its EPS and reused while the EPS is unchanged.
+EPS_RASTER_WORKERS = int(os.environ.get("EPS_RASTER_WORKERS", 4))
+EPS_PREVIEW_DPI = int(os.environ.get("EPS_PREVIEW_DPI", 72))
+EPS_PREVIEW_MAX_DPI = int(os.environ.get("EPS_PREVIEW_MAX_DPI", 300))
+eps_raster_pool = ThreadPoolExecutor(max_workers=max(1, EPS_RASTER_WORKERS), thread_name_prefix="eps-raster")
+_previews_in_flight = {}
+
+def rasterize_eps_png(eps_path, dpi=EPS_PREVIEW_DPI):
+    with Image.open(eps_path) as img:
+        # Ghostscript renders at whole multiples of 72 DPI; anything else is resized down
+        scale = max(1, math.ceil(dpi / 72))
+        img.load(scale=scale)
+        size = (max(1, round(img.width * dpi / (72 * scale))), max(1, round(img.height * dpi / (72 * scale))))
+        img = img.convert("RGB")
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+        buffered = BytesIO()
+        img.save(buffered, format="PNG")
+        return buffered.getvalue()
+
+def preview_path(eps_path, dpi=EPS_PREVIEW_DPI):
+    return f"{os.path.splitext(eps_path)[0]}.preview-{dpi}.png"
+
+def cached_eps_preview(eps_path, dpi=EPS_PREVIEW_DPI):
+    path = preview_path(eps_path, dpi)
     try:
-        logger.info(f"Received eps_path: {eps_path}")
-
-        if not os.path.exists(eps_path):
-            logger.error(f"Error in convert_eps_to_base64: File not found: {eps_path}")
-            return JSONResponse(
-                content=json.dumps({"error": f"File not found: {eps_path}"})
-            )
-
-        logger.info(f"File exists: {eps_path}")
-
-        with Image.open(eps_path) as img:
-            img = img.convert("RGB")
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            img_bytes = buffered.getvalue()
-            img_base64 = base64.b64encode(img_bytes).decode("utf-8")
-
-        return img_base64
-    except HTTPException as http_exc:
-        raise http_exc
-    except Exception as error:
-        logger.error(f"Error in convert_eps_to_base64: {error}")
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "message": "Internal Server Error",
-                "currentFrame": getframeinfo(currentframe()),
-                "detail": str(traceback.format_exc()),
-            },
-        )
-
-async def clean_old_data_prepared():
+        if os.path.getmtime(path) >= os.path.getmtime(eps_path):
+            return path
+    except OSError:
+        pass
+    png_bytes = rasterize_eps_png(eps_path, dpi)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as preview_file:
+        preview_file.write(png_bytes)
+    os.replace(tmp_path, path)
+    return path
+
+async def eps_preview(eps_path, dpi=EPS_PREVIEW_DPI):
+    # Path of the cached preview PNG; concurrent requests for one preview share a render
+    key = (eps_path, dpi)
+    future = _previews_in_flight.get(key)
+    if future is None:
+        future = asyncio.get_running_loop().run_in_executor(eps_raster_pool, cached_eps_preview, eps_path, dpi)
+        _previews_in_flight[key] = future
+        future.add_done_callback(lambda _: _previews_in_flight.pop(key, None))
+    return await asyncio.shield(future)
+
+async def shutdown_eps_raster_pool():
+    eps_raster_pool.shutdown(wait=False, cancel_futures=True)
+
+def vector_cache_key(image_key, mask_digest, mode):
+    # vectorizer.ai output only depends on the source image, the mask applied to it and the mode
+    return f"vector-eps/{mode}/{image_key}/{mask_digest}"
+
+async def save_vector_file(content, file_name, output_dir):
+    size = file_name.split("_", 1)[0]
+    os.makedirs(f"{output_dir}/{size}", exist_ok=True)
+    file_path = f"{output_dir}/{size}/{file_name}.eps"
+    async with aiofiles.open(file_path, "wb") as out_file:
+        await out_file.write(content)
+    return file_path
+
+async def load_cached_vector(cache_key, file_name, output_dir):
+    # Path of the EPS written from the cache, or None when it was never vectorized
+    content = await vector_cache.get(cache_key)
+    if content is None:
+        return None
+    return await save_vector_file(content, file_name, output_dir)
+
+async def generate_vector_image(image_url, file_name, mode, output_dir, cache_key=None):
     try:
-        if not os.path.exists(zip_folder1):
-            os.makedirs(zip_folder1)
-
-        zip_file = f"{zip_folder1}/temp_student_products"
-        if os.path.exists(zip_file + ".zip"):
-            os.remove(zip_file + ".zip")
-
-        shutil.rmtree(zip_folder1)
-        if not os.path.exists(output_folder1):
-            os.makedirs(output_folder1)
-        return "removed"
-    except HTTPException as http_exc:
-        raise http_exc
-    except Exception as error:
-        logger.error(f"Error in clean_old_data : {error}")
+        content = await vectorizer_client.vectorize(image_url, mode)
+        if content is None:
+            return False
+
+        if cache_key:
+            await vector_cache.put(cache_key, content)
+        return await save_vector_file(content, file_name, output_dir)
+    except httpx.RequestError:
         raise HTTPException(
             status_code=500,
             detail={
-                "message": "Internal Server Error",
+                "message": "Vectorization request failed after multiple attempts",
                 "currentFrame": getframeinfo(currentframe()),
                 "detail": str(traceback.format_exc()),
             },
         )
-
-async def clean_old_data():
-    try:
-        if not os.path.exists(zip_folder):
-            os.makedirs(zip_folder)
-
-        zip_file = f"{zip_folder}/temp_student_products.zip"
-        if os.path.exists(zip_file):
-            os.remove(zip_file)
-
-        if os.path.exists(output_folder):
-            shutil.rmtree(output_folder)
-        os.makedirs(output_folder)
-
-        return "removed"
     except Exception as error:
-        logger.error(f"Error in clean_old_data: {error}")
+        logger.error(f"Error in generate_vector_image: {error}")
         raise HTTPException(
             status_code=500,
             detail={
@@ -120,223 +141,95 @@ async def clean_old_data():
             },
         )
 
-async def generate_vector_image(image_url, file_name, mode):
-    retry_attempts = 3
-    timeout_seconds = 60  # Increase timeout in seconds
-
-    for attempt in range(retry_attempts):
+def zip_response(entries, filename, workspace):
+    # Streams the files from the async iterator entries as a ZIP while they
+    # are still being produced; the workspace goes once the stream ends
+    async def archive():
         try:
-            if not os.path.exists(output_folder):
-                os.makedirs(output_folder)
-
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://vectorizer.ai/api/v1/vectorize",
-                    data={
-                        "mode": mode,
-                        "image.url": image_url,
-                        "output.file_format": "eps",
-                    },
-                    auth=(VECTORIZER_TOKEN, VECTORIZER_SECRET),
-                    timeout=timeout_seconds,
-                )
-
-                size = file_name.split("_", 1)[0]
-                if not os.path.exists(f"{output_folder}/{size}"):
-                    os.makedirs(f"{output_folder}/{size}")
-
-                if response.status_code == httpx.codes.OK:
-                    file_path = f"{output_folder}/{size}/{file_name}.eps"
-                    async with aiofiles.open(file_path, "wb") as out_file:
-                        await out_file.write(response.content)
-                    return file_path
-                else:
-                    logger.error(f"Error: {response.status_code} {response.text}")
-                    return False
-
-        except (httpx.RequestError, httpx.TimeoutException) as exc:
-            logger.error(f"Attempt {attempt + 1} failed: {exc}")
-            if attempt == retry_attempts - 1:
-                raise HTTPException(
-                    status_code=500,
-                    detail={
-                        "message": "Vectorization request failed after multiple attempts",
-                        "currentFrame": getframeinfo(currentframe()),
-                        "detail": str(traceback.format_exc()),
-                    },
-                )
-        except Exception as error:
-            logger.error(f"Error in generate_vector_image: {error}")
-            raise HTTPException(
-                status_code=500,
-                detail={
-                    "message": "Internal Server Error",
-                    "currentFrame": getframeinfo(currentframe()),
-                    "detail": str(traceback.format_exc()),
-                },
-            )
-
-async def generate_zip(background_tasks):
-    try:
-        zip_file = f"{zip_folder}/temp_student_products"
-        shutil.make_archive(zip_file, "zip", output_folder)
-
-        # Schedule clean-up tasks
-        background_tasks.add_task(os.remove, zip_file + ".zip")
-        background_tasks.add_task(shutil.rmtree, zip_folder)
-        return f"{zip_file}.zip"
-    except Exception as error:
-        logger.error(f"Error in generate_zip: {error}")
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "message": "Internal Server Error",
-                "currentFrame": getframeinfo(currentframe()),
-                "detail": str(traceback.format_exc()),
-            },
-        )
-
-async def generate_zip_pre(background_tasks):
-    try:
-        zip_file = f"{zip_folder1}/temp_student_products"
-        result = shutil.make_archive(zip_file, "zip", output_folder1)
-
-        background_tasks.add_task(os.remove, zip_file + ".zip")
-        background_tasks.add_task(shutil.rmtree, zip_folder1)
-        return f"{zip_file}.zip"
-    except HTTPException as http_exc:
-        raise http_exc
-    except Exception as error:
-        logger.error(f"Error in generate zip : {error}")
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "message": "Internal Server Error",
-                "currentFrame": getframeinfo(currentframe()),
-                "detail": str(traceback.format_exc()),
-            },
-        )
-
-async def generate_pdf(background_tasks):
-    try:
-        pdf_file = f"{zip_folder}/temp_student_products"
-        folder_path = output_folder
-        image_files = [
-            f
-            for f in os.listdir(folder_path)
-            if f.lower().endswith(("png", "jpg", "jpeg", "eps"))
-        ]
-        image_files.sort()
-
-        if not image_files:
-            return f"{pdf_file}.pdf"
-
-        c = canvas.Canvas(f"{pdf_file}.pdf", pagesize=letter)
-        page_width, page_height = letter
-        for image_file in image_files:
-            image_path = os.path.join(folder_path, image_file)
-            img = Image.open(image_path)
-            img_width, img_height = img.size
-
-            aspect_ratio = img_width / float(img_height)
-            if aspect_ratio > 1:
-                new_width = min(page_width, img_width)
-                new_height = new_width / aspect_ratio
-            else:
-                new_height = min(page_height, img_height)
-                new_width = new_height * aspect_ratio
-
+            async for chunk in stream_zip(entries):
+                yield chunk
+        finally:
+            await asyncio.to_thread(workspace.cleanup)
+
+    return StreamingResponse(
+        archive(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+def fit_to_page(img_width, img_height, page_width, page_height):
+    # Printed size in points: one point per pixel, shrunk to fit the page
+    aspect_ratio = img_width / float(img_height)
+    if aspect_ratio > 1:
+        new_width = min(page_width, img_width)
+        new_height = new_width / aspect_ratio
+    else:
+        new_height = min(page_height, img_height)
+        new_width = new_height * aspect_ratio
+    return new_width, new_height
+
+def scale_to_dpi(img, width, height, dpi):
+    # Embedding pixels beyond what the page can show only grows and slows the PDF
+    target = (max(1, round(width * dpi / 72)), max(1, round(height * dpi / 72)))
+    if img.width <= target[0] and img.height <= target[1]:
+        return img
+    # JPEGs can decode straight at a reduced scale
+    img.draft(img.mode, target)
+    if img.width > target[0] or img.height > target[1]:
+        img = img.resize(target, Image.LANCZOS)
+    return img
+
+def render_folder_pdf(folder_path, pdf_file, dpi=PDF_TARGET_DPI):
+    # One letter page per image in the folder, labelled with its file name
+    image_files = [
+        f for f in os.listdir(folder_path)
+        if f.lower().endswith(("png", "jpg", "jpeg", "eps"))
+    ]
+    image_files.sort()
+
+    if not image_files:
+        return False
+
+    c = canvas.Canvas(pdf_file, pagesize=letter)
+    page_width, page_height = letter
+
+    for image_file in image_files:
+        image_path = os.path.join(folder_path, image_file)
+        with Image.open(image_path) as img:
+            new_width, new_height = fit_to_page(img.width, img.height, page_width, page_height)
             x_offset = (page_width - new_width) / 2
             y_offset = (page_height - new_height) / 2
 
             c.drawImage(
-                ImageReader(img), x_offset, y_offset, width=new_width, height=new_height
+                ImageReader(scale_to_dpi(img, new_width, new_height, dpi)),
+                x_offset, y_offset, width=new_width, height=new_height,
             )
-            c.showPage()
-
-        c.save()
-        background_tasks.add_task(os.remove, pdf_file + ".pdf")
-        background_tasks.add_task(shutil.rmtree, zip_folder)
-        return f"{pdf_file}.pdf"
-    except HTTPException as http_exc:
-        raise http_exc
-    except Exception as error:
-        logger.error(f"Error in generate pdf : {error}")
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "message": "Internal Server Error",
-                "currentFrame": getframeinfo(currentframe()),
-                "detail": str(traceback.format_exc()),
-            },
-        )
-
-async def generate_pdf_pre(background_tasks: BackgroundTasks):
-    try:
-        parent_folder = os.path.join(zip_folder1, "temp_student_products")
-        subfolders = [f.path for f in os.scandir(parent_folder) if f.is_dir()]
-        pdf_files = []
-
-        for folder_path in subfolders:
-            folder_name = os.path.basename(folder_path)
-            pdf_file = os.path.join(output_folder1, f"{folder_name}.pdf")
-            image_files = [
-                f for f in os.listdir(folder_path)
-                if f.lower().endswith(("png", "jpg", "jpeg", "eps"))
-            ]
-            image_files.sort()
-
-            if not image_files:
-                continue
-
-            c = canvas.Canvas(pdf_file, pagesize=letter)
-            page_width, page_height = letter
-
-            for image_file in image_files:
-                image_path = os.path.join(folder_path, image_file)
-                img = Image.open(image_path)
-                img_width, img_height = img.size
-
-                aspect_ratio = img_width / float(img_height)
-                if aspect_ratio > 1:
-                    new_width = min(page_width, img_width)
-                    new_height = new_width / aspect_ratio
-                else:
-                    new_height = min(page_height, img_height)
-                    new_width = new_height * aspect_ratio
 
-                x_offset = (page_width - new_width) / 2
-                y_offset = (page_height - new_height) / 2
+        # Add filename label
+        c.setFont("Helvetica", 10)
+        c.drawString(x_offset, y_offset - 15, image_file)
 
-                c.drawImage(
-                    ImageReader(img), x_offset, y_offset, width=new_width, height=new_height
-                )
+        c.showPage()
 
-                # Add filename label
-                c.setFont("Helvetica", 10)
-                c.drawString(x_offset, y_offset - 15, image_file)
+    c.save()
+    return True
 
-                c.showPage()
+async def render_size_pdf(folder_path, pdf_file):
+    return os.path.basename(pdf_file), pdf_file, await run_in_pool(render_folder_pdf, folder_path, pdf_file)
 
-            c.save()
-            pdf_files.append(pdf_file)
-
-        # Schedule cleanup tasks
-        zip_path = await generate_zip_pre(background_tasks)
-        for pdf_file in pdf_files:
-            background_tasks.add_task(os.remove, pdf_file)
-        background_tasks.add_task(shutil.rmtree, zip_folder)
-
-        return zip_path;
-    except HTTPException as http_exc:
-        raise http_exc
-    except Exception as error:
-        logger.error(f"Error in generate pdf : {error}")
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "message": "Internal Server Error",
-                "currentFrame": getframeinfo(currentframe()),
-                "detail": str(traceback.format_exc()),
-            },
-        )
\ No newline at end of file
+async def generate_pdf_pre(workspace, images_dir):
+    # One PDF per size folder of images_dir. All sizes render at once in the
+    # process pool; each is yielded as (arcname, path) as soon as it is done
+    subfolders = sorted(f.path for f in os.scandir(images_dir) if f.is_dir()) if os.path.isdir(images_dir) else []
+    tasks = [
+        asyncio.create_task(render_size_pdf(folder_path, os.path.join(workspace.files, f"{os.path.basename(folder_path)}.pdf")))
+        for folder_path in subfolders
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            arcname, pdf_file, rendered = await next_done
+            if rendered:
+                yield arcname, pdf_file
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,164 @@
+from utils.disk_cache import DiskLRUCache
+from utils.image_payload import ImagePayload
+import logging
+import asyncio
+import base64
+import httpx
+import time
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Every image download (S3 presigned URLs, masks, product assets) goes through
+# one pooled client so connections are reused and at most
+# IMAGE_FETCH_CONCURRENCY downloads run at once.
+IMAGE_FETCH_CONCURRENCY = int(os.environ.get("IMAGE_FETCH_CONCURRENCY", 16))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("IMAGE_FETCH_TIMEOUT", 10))
+IMAGE_FETCH_RETRIES = int(os.environ.get("IMAGE_FETCH_RETRIES", 2))
+IMAGE_PREFETCH_DEPTH = int(os.environ.get("IMAGE_PREFETCH_DEPTH", 2))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Generated images are immutable per id, so their originals are kept on the
+# volume and reused by print orders, downloads and thumbnails.
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "/mnt/data/image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+
+def browse_image_cache_key(img_id):
+    return f"browse-image-v2/{img_id}" if img_id else None
+
+
+def decode_data_url(data_url):
+    if isinstance(data_url, bytes):
+        data_url = data_url.decode("utf-8")
+    encoded = data_url.split(",", 1)[1]
+    return base64.b64decode(encoded + "=" * (-len(encoded) % 4))
+
+
+class ImageFetcher:
+    def __init__(self, concurrency: int, timeout: float, retries: int, cache: DiskLRUCache = None):
+        self.concurrency = max(1, concurrency)
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self._client = None
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.requests = 0
+        self.failures = 0
+        self.retried = 0
+        self.bytes = 0
+        self.fetch_seconds = 0.0
+        self.in_flight = 0
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0)),
+                follow_redirects=True,
+            )
+        return self._client
+
+    async def fetch(self, url, cache_key=None):
+        # url may also be an ImagePayload or data URL already holding the image
+        if isinstance(url, ImagePayload):
+            return bytes(url)
+        if isinstance(url, bytes) or url.startswith("data:image"):
+            return decode_data_url(url)
+
+        if cache_key and self.cache is not None:
+            content = await self.cache.get(cache_key)
+            if content is not None:
+                return content
+
+        async with self._semaphore:
+            self.in_flight += 1
+            start = time.perf_counter()
+            try:
+                content = await self._get(url)
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                self.in_flight -= 1
+                self.requests += 1
+                self.fetch_seconds += time.perf_counter() - start
+        self.bytes += len(content)
+        if cache_key and self.cache is not None:
+            await self.cache.put(cache_key, content)
+        return content
+
+    async def _get(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.client.get(url)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                    response.raise_for_status()
+                    return response.content
+                logger.warning(f"Image fetch got {response.status_code}, retrying ({attempt + 1}/{self.retries})")
+            except httpx.TransportError as error:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Image fetch failed: {error}, retrying ({attempt + 1}/{self.retries})")
+            self.retried += 1
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def fetch_many(self, urls, cache_keys=None):
+        # One entry per url: the content, or the exception that fetching it raised
+        cache_keys = cache_keys or [None] * len(urls)
+        return await asyncio.gather(
+            *[self.fetch(url, cache_key) for url, cache_key in zip(urls, cache_keys)], return_exceptions=True
+        )
+
+    async def prefetch(self, items, sources_of, depth=IMAGE_PREFETCH_DEPTH):
+        # sources_of(item) gives [(url, cache_key)]. Yields (item, contents) in
+        # order while the images of the next `depth` items download in the background
+        pending = []
+        items = iter(items)
+        try:
+            for item in items:
+                sources = sources_of(item)
+                urls = [url for url, _ in sources]
+                cache_keys = [cache_key for _, cache_key in sources]
+                pending.append((item, asyncio.ensure_future(self.fetch_many(urls, cache_keys))))
+                if len(pending) > depth:
+                    item, task = pending.pop(0)
+                    yield item, await task
+            while pending:
+                item, task = pending.pop(0)
+                yield item, await task
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    def metrics(self):
+        return {
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "retried": self.retried,
+            "bytes": self.bytes,
+            "avg_fetch_ms": round(self.fetch_seconds * 1000 / self.requests, 2) if self.requests else None,
+            "disk_cache": self.cache.metrics() if self.cache is not None else None,
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+image_fetcher = ImageFetcher(
+    IMAGE_FETCH_CONCURRENCY,
+    IMAGE_FETCH_TIMEOUT,
+    IMAGE_FETCH_RETRIES,
+    cache=DiskLRUCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, "image"),
+)
+
+
+async def close_image_fetcher():
+    await image_fetcher.close()
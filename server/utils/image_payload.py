@@ -0,0 +1,66 @@
+from io import BytesIO
+from PIL import Image
+import base64
+
+
+class ImagePayload:
+    # Encoded image bytes (JPEG, PNG, ...) as they travel through the pipeline.
+    # The buffer is never copied or re-encoded to base64 on the way; that only
+    # happens at API boundaries through from_data_url / to_data_url.
+    __slots__ = ("data", "content_type")
+
+    def __init__(self, data, content_type="image/jpeg"):
+        if isinstance(data, ImagePayload):
+            data, content_type = data.data, data.content_type
+        self.data = data
+        self.content_type = content_type
+
+    @classmethod
+    def from_base64(cls, encoded, content_type="image/jpeg"):
+        if isinstance(encoded, str):
+            encoded = encoded.encode("ascii")
+        return cls(base64.b64decode(encoded + b"=" * (-len(encoded) % 4)), content_type)
+
+    @classmethod
+    def from_data_url(cls, data_url):
+        if not isinstance(data_url, str):
+            data_url = bytes(data_url).decode("ascii")
+        if not data_url.startswith("data:") or "," not in data_url:
+            raise ValueError("Invalid image data")
+        header, encoded = data_url.split(",", 1)
+        content_type = header[len("data:"):].split(";", 1)[0] or "image/jpeg"
+        return cls.from_base64(encoded, content_type)
+
+    @classmethod
+    def coerce(cls, value):
+        # Accepts what callers used to pass around: payloads, raw bytes or data URLs
+        if isinstance(value, ImagePayload):
+            return value
+        if isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:5]) != b"data:":
+            return cls(value)
+        return cls.from_data_url(value)
+
+    @property
+    def view(self):
+        return memoryview(self.data)
+
+    def __bytes__(self):
+        # No copy when the payload already holds bytes
+        return self.data if isinstance(self.data, bytes) else bytes(self.data)
+
+    def __len__(self):
+        return self.view.nbytes
+
+    @property
+    def is_jpeg(self):
+        # From the bytes themselves; content_type is only what the sender claimed
+        return bytes(self.view[:3]) == b"\xff\xd8\xff"
+
+    def open(self):
+        return Image.open(BytesIO(self.data))
+
+    def to_base64(self):
+        return base64.b64encode(self.data).decode("ascii")
+
+    def to_data_url(self):
+        return f"data:{self.content_type};base64,{self.to_base64()}"
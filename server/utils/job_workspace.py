@@ -0,0 +1,56 @@
+import logging
+import shutil
+import time
+import re
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Every download job assembles its files in its own directory, so jobs can run
+# side by side. Directories left behind by crashed jobs are removed at startup
+# once they are older than JOB_WORKSPACE_MAX_AGE seconds.
+JOBS_DIR = os.environ.get("JOBS_DIR", "/mnt/data/jobs")
+JOB_WORKSPACE_MAX_AGE = int(os.environ.get("JOB_WORKSPACE_MAX_AGE", 24 * 60 * 60))
+
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+class JobWorkspace:
+    # /mnt/data/jobs/<job_id>: files/ holds what goes into the archive, the
+    # archive itself and any intermediate files live next to it
+    def __init__(self, job_id: str):
+        # Job ids come from clients and end up in a path
+        if not JOB_ID_PATTERN.match(job_id or ""):
+            raise ValueError(f"Invalid job id: {job_id!r}")
+        self.job_id = job_id
+        self.root = os.path.join(JOBS_DIR, job_id)
+        self.files = os.path.join(self.root, "files")
+
+    def create(self):
+        # A job id that is reused starts from an empty workspace
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.files)
+        return self
+
+    def open(self):
+        # Picks up whatever an interrupted run of the same job left behind
+        os.makedirs(self.files, exist_ok=True)
+        return self
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+async def remove_stale_workspaces():
+    if not os.path.isdir(JOBS_DIR):
+        return
+    cutoff = time.time() - JOB_WORKSPACE_MAX_AGE
+    for entry in os.scandir(JOBS_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            logger.info(f"Removing stale job workspace {entry.path}")
+            shutil.rmtree(entry.path, ignore_errors=True)
@@ -0,0 +1,152 @@
+from aws_utils import generate_presigned_url
+from utils.mask_pipeline import GreenMask
+from utils.image_fetcher import image_fetcher
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image
+import numpy as np
+import hashlib
+import logging
+import asyncio
+import base64
+import time
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MASK_BUCKET = "drophouse-skeleton"
+MASK_CACHE_SIZE = int(os.environ.get("MASK_CACHE_SIZE", 32))
+
+
+def decode_mask(image_bytes):
+    pixels = np.asarray(Image.open(BytesIO(image_bytes)).convert("RGBA"))
+    # Cached masks are shared between requests and must never be edited in place
+    pixels.setflags(write=False)
+    mask = GreenMask(pixels, hashlib.sha1(image_bytes).hexdigest())
+    # Recolored shape and cleaned removal region are reused by every image this mask is applied to
+    mask.prepared(recolor=True)
+    return mask
+
+
+class MaskCache:
+    # Green masks keyed by their S3 key (or a digest for inline data URLs),
+    # held as decoded GreenMask arrays with least-recently-used eviction.
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_failures = 0
+        self.load_seconds = 0.0
+
+    async def get(self, source):
+        key, inline_data = self._resolve(source)
+        if key is None:
+            return None
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        # Concurrent requests for the same mask wait on a single download
+        loading = self._loading.get(key)
+        if loading is not None:
+            try:
+                result = await asyncio.shield(loading)
+                self.hits += 1
+                return result
+            except asyncio.CancelledError:
+                # Only the request that started the download was cancelled;
+                # this one loads the mask itself
+                if not loading.cancelled():
+                    raise
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            mask = await self._load(key, inline_data)
+            # invalidate() drops loads that started before it; their mask may be stale
+            if self._loading.get(key) is future:
+                self._store(key, mask)
+            future.set_result(mask)
+        except Exception as e:
+            self.load_failures += 1
+            logger.error(f"Error loading mask {key}: {e}")
+            future.set_result(None)
+        except BaseException:
+            # Cancelled: waiters must not hang on a future nobody resolves
+            future.cancel()
+            raise
+        finally:
+            if self._loading.get(key) is future:
+                del self._loading[key]
+        return future.result()
+
+    async def get_for_organization(self, organization):
+        if not organization:
+            return None
+        return await self.get(organization.get('greenmask'))
+
+    def invalidate(self, source=None):
+        # Loads in flight still answer their callers but are not cached
+        if source is None:
+            self._entries.clear()
+            self._loading.clear()
+            return
+        key, _ = self._resolve(source)
+        self._entries.pop(key, None)
+        self._loading.pop(key, None)
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        loads = self.misses - self.load_failures
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": sum(mask.nbytes for mask in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "load_failures": self.load_failures,
+            "avg_load_ms": round(self.load_seconds * 1000 / loads, 2) if loads > 0 else None,
+            "loading": len(self._loading),
+        }
+
+    def _resolve(self, source):
+        if source is None or source == '' or source == 'null':
+            return None, None
+        if isinstance(source, str) and source.startswith('data:image'):
+            source = source.encode('utf-8')
+        if isinstance(source, bytes):
+            if not source.startswith(b'data:image') or b',' not in source:
+                return None, None
+            inline_data = source.split(b',', 1)[1]
+            return "inline:" + hashlib.sha1(inline_data).hexdigest(), inline_data
+        return source, None
+
+    async def _load(self, key, inline_data):
+        start = time.perf_counter()
+        if inline_data is not None:
+            image_bytes = base64.b64decode(inline_data)
+        else:
+            image_bytes = await image_fetcher.fetch(generate_presigned_url(key, MASK_BUCKET))
+
+        mask = await asyncio.to_thread(decode_mask, image_bytes)
+        self.load_seconds += time.perf_counter() - start
+        return mask
+
+    def _store(self, key, mask):
+        self._entries[key] = mask
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+mask_cache = MaskCache(MASK_CACHE_SIZE)
@@ -0,0 +1,158 @@
+from io import BytesIO
+from PIL import Image
+import numpy as np
+import cv2
+from utils.process_pool import attach_shared
+
+# Green masks mark the printable area; every pixel that is not one of the
+# ignored colors is painted with GREEN, which is then cut out of the composite.
+GREEN = (82, 178, 38, 255)
+IGNORE_COLORS = [(255, 255, 255, 255), (255, 255, 255, 0), (0, 0, 0, 0)]
+BACKGROUND_SIZE = (512, 512)
+PRINT_DPI = (400, 400)
+MORPH_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+
+
+def _pack(color):
+    return np.array([color], dtype=np.uint8).view(np.uint32)[0]
+
+
+def recolor_greenmask(mask):
+    mask = np.ascontiguousarray(mask, dtype=np.uint8)
+    # One uint32 per RGBA pixel turns each color test into a single comparison
+    pixels = mask.view(np.uint32)[..., 0]
+    keep = pixels == _pack(GREEN)
+    for color in IGNORE_COLORS:
+        keep |= pixels == _pack(color)
+
+    recolored = mask.copy()
+    recolored[~keep] = GREEN
+    return recolored
+
+
+def decode_background(image_bytes):
+    return np.asarray(Image.open(BytesIO(image_bytes)).resize(BACKGROUND_SIZE).convert("RGBA"))
+
+
+def composite_greenmask(shape, background):
+    shape_image = Image.fromarray(shape)
+    composite_image = Image.composite(shape_image, Image.fromarray(background), shape_image.getchannel("A"))
+    return np.asarray(composite_image)
+
+
+def _clean_region(mask):
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, MORPH_KERNEL)
+    return cv2.morphologyEx(mask, cv2.MORPH_OPEN, MORPH_KERNEL)
+
+
+def green_region_mask(image):
+    green = np.array(GREEN, dtype=np.uint8)
+    return _clean_region(cv2.inRange(image, green, green))
+
+
+def remove_green_background(image):
+    # Pixels inside the cleaned green region become fully transparent black
+    result = image.copy()
+    result[green_region_mask(image) > 0] = 0
+    return result
+
+
+def encode_png(image, dpi=PRINT_DPI):
+    buffered = BytesIO()
+    Image.fromarray(image).save(buffered, format="PNG", dpi=dpi)
+    return buffered.getvalue()
+
+
+def render_masked_png(shape, background_bytes):
+    background = decode_background(background_bytes)
+    return encode_png(remove_green_background(composite_greenmask(shape, background)))
+
+
+class PreparedMask:
+    # Everything about a green mask that does not depend on the background
+    # image, computed once per mask instead of once per image.
+    def __init__(self, shape):
+        self.shape = np.ascontiguousarray(shape)
+        alpha = self.shape[..., 3]
+        opaque = alpha == 255
+        # Image.composite only reduces to a per-pixel select when alpha is 0 or 255
+        self.binary_alpha = bool(np.all(opaque | (alpha == 0)))
+        self.transparent = alpha == 0
+        packed = self.shape.view(np.uint32)[..., 0]
+        self.green = ((packed == _pack(GREEN)) & opaque).astype(np.uint8) * 255
+        self.region = _clean_region(self.green)
+        self._select(packed, opaque)
+
+    def _select(self, packed, opaque):
+        # Result is either the mask pixel, the background pixel, or zero inside
+        # the cleaned region; folding the zeroing into the mask pixels leaves a
+        # single select per image
+        cut = self.region > 0
+        self.fixed = np.where(cut | ~opaque, 0, packed).astype(np.uint32)
+        self.show_background = ~opaque & ~cut
+
+    SHARED_FIELDS = ("shape", "transparent", "green", "region", "fixed", "show_background")
+
+    def arrays(self):
+        arrays = {field: getattr(self, field) for field in self.SHARED_FIELDS}
+        arrays["binary_alpha"] = np.array(self.binary_alpha)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        # Rebuilds a prepared mask around existing (e.g. shared memory) arrays without recomputing it
+        prepared = cls.__new__(cls)
+        for field in cls.SHARED_FIELDS:
+            setattr(prepared, field, arrays[field])
+        prepared.binary_alpha = bool(arrays["binary_alpha"])
+        return prepared
+
+    @property
+    def nbytes(self):
+        return (self.shape.nbytes + self.transparent.nbytes + self.green.nbytes + self.region.nbytes
+                + self.fixed.nbytes + self.show_background.nbytes)
+
+    def apply(self, background):
+        if not self.binary_alpha:
+            return remove_green_background(composite_greenmask(self.shape, background))
+
+        background = np.ascontiguousarray(background, dtype=np.uint8).view(np.uint32)[..., 0]
+        fixed, show_background = self.fixed, self.show_background
+        # Background pixels that show through and happen to be exactly GREEN
+        # change the region, so only then is the morphology redone
+        background_green = self.transparent & (background == _pack(GREEN))
+        if background_green.any():
+            cut = _clean_region(self.green | (background_green.astype(np.uint8) * 255)) > 0
+            fixed = np.where(cut, 0, fixed).astype(np.uint32)
+            show_background = show_background & ~cut
+        result = fixed.copy()
+        np.copyto(result, background, where=show_background)
+        return result.view(np.uint8).reshape(result.shape + (4,))
+
+
+class GreenMask:
+    # A decoded mask as stored in the mask cache, with its prepared variants
+    # (recolored for print orders, as-is for prepared downloads) built on first use.
+    def __init__(self, pixels, digest):
+        self.pixels = pixels
+        self.digest = digest
+        self._prepared = {}
+
+    @property
+    def nbytes(self):
+        return self.pixels.nbytes + sum(prepared.nbytes for prepared in self._prepared.values())
+
+    def prepared(self, recolor=True):
+        if recolor not in self._prepared:
+            shape = recolor_greenmask(self.pixels) if recolor else np.ascontiguousarray(self.pixels)
+            self._prepared[recolor] = PreparedMask(shape)
+        return self._prepared[recolor]
+
+
+def render_prepared_png(prepared, background_bytes):
+    return encode_png(prepared.apply(decode_background(background_bytes)))
+
+
+def render_shared_png(handle, background_bytes):
+    # Process pool entry point: the prepared mask arrives as a shared memory handle
+    return render_prepared_png(PreparedMask.from_arrays(attach_shared(handle)), background_bytes)
@@ -0,0 +1,41 @@
+from database.UserOperations import STATUS_UPDATED, STATUS_UNCHANGED
+from collections import Counter
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class OrderStatusBatch:
+    # Orders a job has finished with, moved to new_status together through
+    # UserOperations.update_status_many instead of one update per image
+    def __init__(self, db_ops, new_status, reason=''):
+        self.db_ops = db_ops
+        self.new_status = new_status
+        self.reason = reason
+        self.pending = {}
+        self.outcomes = {}
+
+    def add(self, order):
+        # Orders with several images are only updated once
+        order_id = order["order_id"]
+        if self.outcomes.get(order_id) not in (STATUS_UPDATED, STATUS_UNCHANGED):
+            self.pending[order_id] = order
+
+    async def flush(self):
+        if not self.pending:
+            return {}
+        order_ids, self.pending = list(self.pending), {}
+        outcomes = await self.db_ops.update_status_many(order_ids, self.new_status, self.reason)
+        self.outcomes.update(outcomes)
+        for order_id, outcome in outcomes.items():
+            if outcome not in (STATUS_UPDATED, STATUS_UNCHANGED):
+                logger.error(f"Not able to update status to {self.new_status} ({outcome}): {order_id}")
+        logger.info(f"Order status {self.new_status}: {dict(Counter(outcomes.values()))}")
+        return outcomes
+
+    def summary(self):
+        return dict(Counter(self.outcomes.values()))
+
+    def failed(self):
+        return [order_id for order_id, outcome in self.outcomes.items() if outcome not in (STATUS_UPDATED, STATUS_UNCHANGED)]
@@ -0,0 +1,146 @@
+from bson import Binary
+
+# Organization image fields hold S3 keys in the drophouse-skeleton bucket
+# (see create_organisation). Anything longer than this, or any data: URL /
+# binary value, is an inline blob left over from the pre-S3 layout.
+MAX_ASSET_KEY_BYTES = 2048
+
+ORG_ASSET_FIELDS = ["mask", "logo", "greenmask", "favicon"]
+LANDINGPAGE_ASSET_FIELDS = ["asset", "asset_back"]
+PRODUCT_ASSET_FIELDS = ["mask", "greenmask", "defaultProduct"]
+COLOR_ASSET_FIELDS = ["front", "back"]
+
+
+def iter_asset_fields(org):
+    for field in ORG_ASSET_FIELDS:
+        if field in org:
+            yield field, org, field
+
+    for idx, page in enumerate(org.get("landingpage") or []):
+        for field in LANDINGPAGE_ASSET_FIELDS:
+            if field in page:
+                yield f"landingpage.{idx}.{field}", page, field
+
+    for idx, product in enumerate(org.get("products") or []):
+        for field in PRODUCT_ASSET_FIELDS:
+            if field in product:
+                yield f"products.{idx}.{field}", product, field
+        for color, color_data in (product.get("colors") or {}).items():
+            asset = (color_data or {}).get("asset") or {}
+            for field in COLOR_ASSET_FIELDS:
+                if field in asset:
+                    yield f"products.{idx}.colors.{color}.asset.{field}", asset, field
+
+
+def is_inline_blob(value) -> bool:
+    # OrganizationModel defaults defaultProduct to an empty b"data:image/png;base64"
+    # placeholder; a data URL without a payload carries no image.
+    if isinstance(value, (bytes, Binary)):
+        value = bytes(value)
+        return not (value.startswith(b"data:") and b"," not in value)
+    if isinstance(value, str):
+        if value.startswith("data:"):
+            return "," in value
+        return len(value.encode("utf-8")) > MAX_ASSET_KEY_BYTES
+    return False
+
+
+def blob_size(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return len(value)
+
+
+def find_inline_assets(org):
+    return [
+        (path, blob_size(container[field]))
+        for path, container, field in iter_asset_fields(org)
+        if is_inline_blob(container[field])
+    ]
+
+
+def _asset_key_only(expr):
+    # Keeps S3 keys and nulls out inline blobs inside Mongo, so they never cross the wire
+    return {
+        "$cond": [
+            {"$eq": [{"$type": expr}, "string"]},
+            {
+                "$cond": [
+                    {
+                        "$and": [
+                            {"$lte": [{"$strLenBytes": expr}, MAX_ASSET_KEY_BYTES]},
+                            {"$ne": [{"$substrCP": [expr, 0, 5]}, "data:"]},
+                        ]
+                    },
+                    expr,
+                    None,
+                ]
+            },
+            None,
+        ]
+    }
+
+
+def slim_organization_stages(include_id: bool = False):
+    color_assets = {
+        "$arrayToObject": {
+            "$map": {
+                "input": {"$objectToArray": "$$p.colors"},
+                "as": "c",
+                "in": {
+                    "k": "$$c.k",
+                    "v": {
+                        "$mergeObjects": [
+                            "$$c.v",
+                            {
+                                "asset": {
+                                    "$mergeObjects": [
+                                        "$$c.v.asset",
+                                        {field: _asset_key_only(f"$$c.v.asset.{field}") for field in COLOR_ASSET_FIELDS},
+                                    ]
+                                }
+                            },
+                        ]
+                    },
+                },
+            }
+        }
+    }
+    product_assets = {field: _asset_key_only(f"$$p.{field}") for field in PRODUCT_ASSET_FIELDS}
+    product_assets["colors"] = {"$ifNull": [color_assets, {}]}
+
+    slim_fields = {field: _asset_key_only(f"${field}") for field in ORG_ASSET_FIELDS}
+    slim_fields["landingpage"] = {
+        "$ifNull": [
+            {
+                "$map": {
+                    "input": "$landingpage",
+                    "as": "lp",
+                    "in": {
+                        "$mergeObjects": [
+                            "$$lp",
+                            {field: _asset_key_only(f"$$lp.{field}") for field in LANDINGPAGE_ASSET_FIELDS},
+                        ]
+                    },
+                }
+            },
+            [],
+        ]
+    }
+    slim_fields["products"] = {
+        "$ifNull": [
+            {
+                "$map": {
+                    "input": "$products",
+                    "as": "p",
+                    "in": {"$mergeObjects": ["$$p", product_assets]},
+                }
+            },
+            [],
+        ]
+    }
+
+    stages = [{"$set": slim_fields}]
+    if not include_id:
+        stages.append({"$project": {"_id": 0}})
+    return stages
@@ -1,19 +1,17 @@
 from botocore.exceptions import NoCredentialsError
 from inspect import currentframe, getframeinfo
 from aws_utils import generate_presigned_url
+from utils.mask_pipeline import render_shared_png
+from utils.process_pool import image_pool
+from utils.image_fetcher import image_fetcher, browse_image_cache_key
 from botocore.client import Config
 from fastapi import HTTPException
-from io import BytesIO
-from PIL import Image
-import numpy as np
 import traceback
 import requests
 import logging
-import base64
+import asyncio
 import boto3
-import httpx
-import uuid
-import cv2
+import time
 import os
 import io
 
@@ -23,82 +21,54 @@ logger = logging.getLogger(__name__)
 BASE_URL = "https://api.printful.com"
 PRIVATE_TOKEN = os.environ.get("PRINTFUL_PRIVATE_TOKEN")
 
-process_folder = "/mnt/data/pre_processing_printful_images/"
-if not os.path.exists(process_folder):
-    os.makedirs(process_folder)
-
-
-def image_to_base64(image_path):
-    with open(image_path, "rb") as img_file:
-        encoded_string = base64.b64encode(img_file.read())
-        return encoded_string.decode("utf-8")
-
-async def applyMask_and_removeBackground(input_image_url, mask_data, img_id):
+# Building the product/variant map crawls every store product on Printful,
+# so it is kept for PRINTFUL_MAP_TTL seconds between crawls.
+PRINTFUL_MAP_TTL = int(os.environ.get("PRINTFUL_MAP_TTL", 3600))
+product_map_cache = {"product_map": None, "expires_at": 0.0}
+product_map_lock = asyncio.Lock()
+
+# Images that share a mask are fetched and masked MASK_BATCH_SIZE at a time;
+# each image is still its own pool task so a batch spreads over the workers
+MASK_BATCH_SIZE = int(os.environ.get("MASK_BATCH_SIZE", 16))
+
+async def render_masked_png(mask_data, background_bytes, recolor=True):
+    # The prepared mask is published to the image pool once and shared by every image it is applied to
+    prepared = mask_data.prepared(recolor=recolor)
+    async with image_pool.shared(f"{mask_data.digest}:{int(recolor)}", prepared.arrays) as mask_handle:
+        return await image_pool.run(render_shared_png, mask_handle, background_bytes)
+
+async def render_masked_pngs(mask_data, backgrounds, recolor=True):
+    # Returns (png_bytes, None) or (None, error) per background, in order
+    prepared = mask_data.prepared(recolor=recolor)
+    async with image_pool.shared(f"{mask_data.digest}:{int(recolor)}", prepared.arrays) as mask_handle:
+        rendered = await asyncio.gather(
+            *[image_pool.run(render_shared_png, mask_handle, background) for background in backgrounds],
+            return_exceptions=True,
+        )
+    return [(None, str(result)) if isinstance(result, Exception) else (result, None) for result in rendered]
+
+def order_image_source(order_image):
+    # (url, disk cache key) of an image entry built by UserOperations.get_student_order
+    return order_image["img_path"], browse_image_cache_key(order_image.get("img_key"))
+
+def batch_by_mask(entries, mask_of):
+    # Groups entries by their mask, in first-seen order, into chunks of MASK_BATCH_SIZE
+    groups = {}
+    for entry in entries:
+        mask = mask_of(entry)
+        groups.setdefault(mask.digest, (mask, []))[1].append(entry)
+    for mask, group in groups.values():
+        for start in range(0, len(group), MASK_BATCH_SIZE):
+            yield mask, group[start:start + MASK_BATCH_SIZE]
+
+async def applyMask_and_removeBackground(input_image_url, mask_data, img_id, cache_key=None):
     try:
-        target_color = (82, 178, 38, 255)
-        ignore_colors = [(255,255,255,255), (255, 255, 255, 0), (0, 0, 0, 0)]
-
-        image_bytes = base64.b64decode(mask_data)
-        shape_image = Image.open(BytesIO(image_bytes)).convert("RGBA")
-        # shape_image = Image.open(mask_path).convert("RGBA")
-        
-        data = shape_image.getdata()
-        new_data = []
-        for idx, pixel in enumerate(data):
-            if pixel[:4] != target_color and pixel[:4] not in ignore_colors:
-                new_data.append(target_color)
-            else:
-                new_data.append(pixel)
-
-        shape_image.putdata(new_data)
-        # shape_image.save('./images/masks/test_mask.png')
-
-        unique_id = uuid.uuid4()
-        image_path = os.path.join(process_folder, f'{unique_id}.png')
-
-        if 'data:image' in input_image_url:
-            input_image_url = input_image_url.split(",")[1]
-            jpeg_data = base64.b64decode(input_image_url)
-            background_image = Image.open(BytesIO(jpeg_data)).resize((512, 512)).convert("RGBA")
-        else:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(input_image_url, timeout=10.0)
-                background_image = Image.open(BytesIO(response.content)).resize((512, 512)).convert("RGBA")
-
-        if not background_image:
+        background_bytes = await image_fetcher.fetch(input_image_url, cache_key)
+        if not background_bytes:
             raise Exception("Image not found")
 
-        r, g, b, a = shape_image.split()
-        composite_image = Image.composite(shape_image, background_image, a)
-        composite_image.save(image_path)
-
-        image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-        os.remove(image_path)
-
-        image_bgr = cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)
-        lower_green = np.array([82, 178, 38, 255], dtype=np.uint8)
-        upper_green = np.array([82, 178, 38, 255], dtype=np.uint8)
-
-        mask = cv2.inRange(image_bgr, lower_green, upper_green)
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-
-        mask_inv = cv2.bitwise_not(mask)
-        foreground = cv2.bitwise_and(image, image, mask=mask_inv)
-        b, g, r, a = cv2.split(foreground)
-        alpha_channel = cv2.bitwise_and(a, a, mask=mask_inv)
-        foreground_with_alpha = cv2.merge([b, g, r, alpha_channel])
-
-        cv2.imwrite(image_path, foreground_with_alpha)
-
-        with Image.open(image_path) as img:
-            img.save(image_path, dpi=(400, 400))
-
-        base64_string = image_to_base64(image_path)
-        os.remove(image_path)
-
-        url = processAndSaveImage(base64_string, img_id)
+        png_bytes = await render_masked_png(mask_data, background_bytes, recolor=True)
+        url = upload_masked_image(png_bytes, img_id)
         return url
     except Exception as error:
         logger.error(f"Error in applyMask_and_removeBackground: {error}")
@@ -111,76 +81,63 @@ async def applyMask_and_removeBackground(input_image_url, mask_data, img_id):
             },
         )
 
-def applyMask_and_removeBackground_file(input_image_url, mask_data, img_id, image_path):
-    try:
-        # shape_image = Image.open(mask_path).convert("RGBA")
-        image_bytes = base64.b64decode(mask_data)
-        shape_image = Image.open(BytesIO(image_bytes)).convert("RGBA")
-        
-        if 'data:image' in input_image_url:
-            input_image_url = input_image_url.split(",")[1]
-            jpeg_data = base64.b64decode(input_image_url)
-            background_image = Image.open(BytesIO(jpeg_data)).resize((512, 512)).convert("RGBA")
+async def applyMask_and_removeBackground_batch(images, mask_data):
+    # images is [(input_image_url, cache_key, img_id)]; returns the masked image URL, or the exception, per image
+    results = [None] * len(images)
+    backgrounds = await image_fetcher.fetch_many(
+        [input_image_url for input_image_url, _, _ in images], [cache_key for _, cache_key, _ in images]
+    )
+    pending = []
+    for index, background in enumerate(backgrounds):
+        if isinstance(background, Exception):
+            results[index] = background
+        elif not background:
+            results[index] = Exception("Image not found")
         else:
-            response = requests.get(input_image_url)
-            background_image = Image.open(BytesIO(response.content)).resize((512, 512)).convert("RGBA")
-        
-        if not background_image:
+            pending.append(index)
+    if not pending:
+        return results
+
+    rendered = await render_masked_pngs(mask_data, [backgrounds[index] for index in pending], recolor=True)
+
+    async def upload(index, png_bytes, error):
+        if error:
+            logger.error(f"Error in applyMask_and_removeBackground_batch: {error}")
+            results[index] = Exception(error)
+            return
+        try:
+            results[index] = await asyncio.to_thread(upload_masked_image, png_bytes, images[index][2])
+        except Exception as upload_error:
+            results[index] = upload_error
+
+    await asyncio.gather(*[upload(index, *result) for index, result in zip(pending, rendered)])
+    return results
+
+def check_backgrounds(backgrounds):
+    # backgrounds as returned by image_fetcher.fetch_many; any missing image fails the batch
+    for background in backgrounds:
+        if isinstance(background, Exception):
+            raise background
+        if not background:
             raise Exception("Image not found")
-        
-        r, g, b, a = shape_image.split()
-        composite_image = Image.composite(shape_image, background_image, a)
-        composite_image.save(image_path)
-
-        image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-        os.remove(image_path)
-        
-        image_bgr = cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)
-        
-        lower_green = np.array([82, 178, 38, 255], dtype=np.uint8)
-        upper_green = np.array([82, 178, 38, 255], dtype=np.uint8)
-        
-        mask = cv2.inRange(image_bgr, lower_green, upper_green)
-
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-        
-        mask_inv = cv2.bitwise_not(mask)
-        foreground = cv2.bitwise_and(image, image, mask=mask_inv)
-        
-        b, g, r, a = cv2.split(foreground)
-        alpha_channel = cv2.bitwise_and(a, a, mask=mask_inv)
-        foreground_with_alpha = cv2.merge([b, g, r, alpha_channel])
-        
-        cv2.imwrite(image_path, foreground_with_alpha)
-        with Image.open(image_path) as img:
-            img.save(image_path, dpi=(400, 400))
-
-        return image_path
-    except Exception as error:
-        logger.error(f"Error in printful_utils : {error}")
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "message": "Internal Server Error",
-                "currentFrame": getframeinfo(currentframe()),
-                "detail": str(traceback.format_exc()),
-            },
-        )
-
-def processAndSaveImage(image_data: str, img_id: str):
+    return backgrounds
+
+async def render_masked_png_files(mask_data, backgrounds):
+    # Print-ready PNG per background, failing the whole batch like the single-image version did
+    rendered = await render_masked_pngs(mask_data, backgrounds, recolor=False)
+    for _, error in rendered:
+        if error:
+            raise Exception(error)
+    return [png_bytes for png_bytes, _ in rendered]
+
+def write_files(paths, contents):
+    for path, content in zip(paths, contents):
+        with open(path, "wb") as output_file:
+            output_file.write(content)
+    return paths
+
+def upload_masked_image(png_bytes: bytes, img_id: str):
     try:
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-
-        # if image.mode == 'RGBA':
-        # image = image.convert('RGB')
-
-        buffered = io.BytesIO()
-        # image.save(buffered, format="JPEG", quality=85)
-        image.save(buffered, format="PNG", quality=100)
-        compressed_image_bytes = buffered.getvalue()
         s3_client = boto3.client(
             "s3", region_name="us-east-2", config=Config(signature_version="s3v4")
         )
@@ -189,7 +146,7 @@ def processAndSaveImage(image_data: str, img_id: str):
         s3_bucket_name = "masked-images"
 
         s3_client.upload_fileobj(
-            io.BytesIO(compressed_image_bytes),
+            io.BytesIO(png_bytes),
             s3_bucket_name,
             image_key,
             # ExtraArgs={"ACL": "public-read", "ContentType": "image/jpeg", "ContentDisposition": "inline"},
@@ -208,7 +165,7 @@ def processAndSaveImage(image_data: str, img_id: str):
             },
         )
     except Exception as error:
-        logger.error(f"Error in processAndSaveImage: {error}")
+        logger.error(f"Error in upload_masked_image: {error}")
         raise HTTPException(
             status_code=500,
             detail={
@@ -340,3 +297,16 @@ def products_and_variants_map():
         }
 
     return product_map
+
+
+async def get_products_and_variants_map(refresh=False):
+    if not refresh and product_map_cache["product_map"] is not None and time.monotonic() < product_map_cache["expires_at"]:
+        return product_map_cache["product_map"]
+
+    async with product_map_lock:
+        if not refresh and product_map_cache["product_map"] is not None and time.monotonic() < product_map_cache["expires_at"]:
+            return product_map_cache["product_map"]
+        product_map = await asyncio.to_thread(products_and_variants_map)
+        product_map_cache["product_map"] = product_map
+        product_map_cache["expires_at"] = time.monotonic() + PRINTFUL_MAP_TTL
+        return product_map
@@ -0,0 +1,201 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from multiprocessing import get_context, shared_memory
+from collections import OrderedDict
+import numpy as np
+import functools
+import logging
+import asyncio
+import time
+import sys
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Pixel work (mask application, preview compositing, PDF pages)
+# runs in worker processes so it never holds the event loop or the GIL.
+# IMAGE_POOL_WORKERS=0 runs the same functions on a thread instead (local dev).
+IMAGE_POOL_WORKERS = int(os.environ.get("IMAGE_POOL_WORKERS", os.cpu_count() or 1))
+IMAGE_POOL_SHARED_ENTRIES = int(os.environ.get("IMAGE_POOL_SHARED_ENTRIES", 32))
+
+
+class SharedArrays:
+    # A set of numpy arrays copied once into a single shared memory block.
+    # Tasks carry only the small picklable handle; workers map the block.
+    def __init__(self, arrays: dict):
+        layout = []
+        offset = 0
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            layout.append((key, array.dtype.str, array.shape, offset))
+            # Keep every array 64-byte aligned inside the block
+            offset += (array.nbytes + 63) // 64 * 64
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for (key, dtype, shape, start), array in zip(layout, arrays.values()):
+            view = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=start)
+            view[...] = array
+            del view
+        self.handle = (self.shm.name, tuple(layout))
+        self.nbytes = offset
+        self.refs = 0
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Blocks mapped by this (worker) process, by shared memory name
+_attached = OrderedDict()
+
+
+def attach_shared(handle):
+    name, layout = handle
+    if name in _attached:
+        _attached.move_to_end(name)
+        return _attached[name][1]
+
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        # Pool workers share the parent's resource tracker, so this registration
+        # does not lead to the block being unlinked when a worker exits
+        shm = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    for key, dtype, shape, offset in layout:
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        array.setflags(write=False)
+        arrays[key] = array
+    _attached[name] = (shm, arrays)
+
+    while len(_attached) > IMAGE_POOL_SHARED_ENTRIES:
+        _, (old_shm, old_arrays) = _attached.popitem(last=False)
+        old_arrays.clear()
+        try:
+            old_shm.close()
+        except BufferError:
+            # Still referenced by an object built on top of it; the mapping goes with the process
+            pass
+    return arrays
+
+
+def _timed_call(fn, args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class ImageProcessPool:
+    def __init__(self, max_workers: int):
+        self.max_workers = max(0, max_workers)
+        self._executor = None
+        self._shared = OrderedDict()
+        self._stats = {}
+        self.running = 0
+
+    def start(self):
+        if self._executor is None and self.max_workers > 0:
+            # spawn keeps Mongo/HTTP client state and threads out of the workers
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=get_context("spawn"))
+            logger.info(f"Image process pool started with {self.max_workers} workers")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        for entry in self._shared.values():
+            entry.close()
+        self._shared.clear()
+
+    async def run(self, fn, *args):
+        self.start()
+        name = getattr(getattr(fn, "func", fn), "__qualname__", repr(fn))
+        stats = self._stats.setdefault(name, {"calls": 0, "failures": 0, "total_s": 0.0, "max_s": 0.0, "compute_s": 0.0})
+        start = time.perf_counter()
+        self.running += 1
+        try:
+            executor = self._executor
+            if executor is None:
+                result, compute = await asyncio.to_thread(_timed_call, fn, args)
+            else:
+                loop = asyncio.get_running_loop()
+                try:
+                    result, compute = await loop.run_in_executor(executor, _timed_call, fn, args)
+                except BrokenProcessPool:
+                    # A worker died (e.g. out of memory); replace the pool so later tasks still run
+                    if self._executor is executor:
+                        logger.error(f"Image process pool broke while running {name}, restarting it")
+                        executor.shutdown(wait=False)
+                        self._executor = None
+                    raise
+        except Exception:
+            stats["failures"] += 1
+            raise
+        finally:
+            self.running -= 1
+            elapsed = time.perf_counter() - start
+            stats["calls"] += 1
+            stats["total_s"] += elapsed
+            stats["max_s"] = max(stats["max_s"], elapsed)
+        stats["compute_s"] += compute
+        return result
+
+    @asynccontextmanager
+    async def shared(self, key, build_arrays):
+        # Publishes build_arrays() once per key and keeps it mapped while in use
+        entry = self._shared.get(key)
+        if entry is None:
+            entry = self._shared[key] = SharedArrays(build_arrays())
+        self._shared.move_to_end(key)
+        entry.refs += 1
+        try:
+            yield entry.handle
+        finally:
+            entry.refs -= 1
+            self._evict()
+
+    def _evict(self):
+        for key in list(self._shared):
+            if len(self._shared) <= IMAGE_POOL_SHARED_ENTRIES:
+                break
+            if self._shared[key].refs == 0:
+                self._shared.pop(key).close()
+
+    def metrics(self):
+        tasks = {}
+        for name, stats in self._stats.items():
+            calls = stats["calls"]
+            succeeded = calls - stats["failures"]
+            tasks[name] = {
+                "calls": calls,
+                "failures": stats["failures"],
+                "avg_ms": round(stats["total_s"] * 1000 / calls, 2) if calls else None,
+                "max_ms": round(stats["max_s"] * 1000, 2),
+                "avg_compute_ms": round(stats["compute_s"] * 1000 / succeeded, 2) if succeeded else None,
+            }
+        return {
+            "workers": self.max_workers,
+            "started": self._executor is not None,
+            "running": self.running,
+            "shared_entries": len(self._shared),
+            "shared_bytes": sum(entry.nbytes for entry in self._shared.values()),
+            "tasks": tasks,
+        }
+
+
+image_pool = ImageProcessPool(IMAGE_POOL_WORKERS)
+
+
+async def run_in_pool(fn, *args, **kwargs):
+    if kwargs:
+        fn = functools.partial(fn, **kwargs)
+    return await image_pool.run(fn, *args)
+
+
+async def start_image_pool():
+    image_pool.start()
+
+
+async def shutdown_image_pool():
+    image_pool.shutdown()
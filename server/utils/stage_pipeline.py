@@ -0,0 +1,135 @@
+import logging
+import asyncio
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage:
+    # fn(item) -> item for the next stage. `concurrency` workers pull from a
+    # queue of at most `queue_size` items, so a slow stage holds back the
+    # stages in front of it instead of piling up work in memory
+    def __init__(self, name, fn, concurrency=1, queue_size=None):
+        self.name = name
+        self.fn = fn
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(1, queue_size or self.concurrency * 2)
+
+
+class StageMetrics:
+    # Kept per pipeline name across runs
+    def __init__(self, stage):
+        self.concurrency = stage.concurrency
+        self.queue_size = stage.queue_size
+        self.processed = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.active_seconds = 0.0
+        self.max_queued = 0
+        self.running = 0
+        self.queued = 0
+
+    def as_dict(self):
+        calls = self.processed + self.failures
+        return {
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "processed": self.processed,
+            "failures": self.failures,
+            "running": self.running,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "avg_ms": round(self.busy_seconds * 1000 / calls, 2) if calls else None,
+            # Waiting on a full downstream queue: this stage is ahead of the next one
+            "blocked_s": round(self.wait_seconds, 2),
+            "items_per_s": round(self.processed / self.active_seconds, 2) if self.active_seconds else None,
+        }
+
+
+class StagePipeline:
+    def __init__(self, name, stages):
+        self.name = name
+        self.stages = stages
+        self.runs = 0
+        self.failed_runs = 0
+        self.metrics_by_stage = {stage.name: StageMetrics(stage) for stage in stages}
+
+    async def run(self, items):
+        # Feeds items through every stage and returns the last stage's results
+        # in completion order. The first failure cancels the run and is raised.
+        queues = [asyncio.Queue(stage.queue_size) for stage in self.stages]
+        results = []
+        start = time.perf_counter()
+        self.runs += 1
+
+        async def feed():
+            for item in items:
+                await queues[0].put(item)
+                self._observe(0, queues[0])
+            for _ in range(self.stages[0].concurrency):
+                await queues[0].put(_DONE)
+
+        async def work(index, remaining):
+            stage = self.stages[index]
+            metrics = self.metrics_by_stage[stage.name]
+            inbox = queues[index]
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            while (item := await inbox.get()) is not _DONE:
+                metrics.queued = inbox.qsize()
+                metrics.running += 1
+                began = time.perf_counter()
+                try:
+                    result = await stage.fn(item)
+                except Exception:
+                    metrics.failures += 1
+                    raise
+                finally:
+                    metrics.running -= 1
+                    metrics.busy_seconds += time.perf_counter() - began
+                metrics.processed += 1
+                if outbox is None:
+                    results.append(result)
+                    continue
+                blocked = time.perf_counter()
+                await outbox.put(result)
+                metrics.wait_seconds += time.perf_counter() - blocked
+                self._observe(index + 1, outbox)
+            # The last worker of a stage to finish tells the next stage's workers
+            remaining[0] -= 1
+            if remaining[0] == 0 and outbox is not None:
+                for _ in range(self.stages[index + 1].concurrency):
+                    await outbox.put(_DONE)
+
+        tasks = [asyncio.create_task(feed())]
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.concurrency]
+            tasks += [asyncio.create_task(work(index, remaining)) for _ in range(stage.concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            self.failed_runs += 1
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            for metrics in self.metrics_by_stage.values():
+                metrics.active_seconds += elapsed
+        return results
+
+    def _observe(self, index, queue):
+        metrics = self.metrics_by_stage[self.stages[index].name]
+        metrics.queued = queue.qsize()
+        metrics.max_queued = max(metrics.max_queued, metrics.queued)
+
+    def metrics(self):
+        return {
+            "runs": self.runs,
+            "failed_runs": self.failed_runs,
+            "stages": {name: metrics.as_dict() for name, metrics in self.metrics_by_stage.items()},
+        }
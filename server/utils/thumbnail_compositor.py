@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image
+import numpy as np
+import threading
+import logging
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Decoded product templates kept per process, by (template key, dimensions)
+THUMBNAIL_TEMPLATE_CACHE = int(os.environ.get("THUMBNAIL_TEMPLATE_CACHE", 16))
+# Thumbnails rendered per process pool task
+THUMBNAIL_BATCH_SIZE = int(os.environ.get("THUMBNAIL_BATCH_SIZE", 16))
+THUMBNAIL_JPEG_QUALITY = 85
+
+
+def percentage_to_pixels(percentage, total_pixels):
+    return (percentage / 100) * total_pixels
+
+
+def _div255(value):
+    # Pillow's rounded division by 255, so blends match Image.paste bit for bit
+    value = value + 128
+    return ((value >> 8) + value) >> 8
+
+
+def _blend(under, over, alpha):
+    return _div255(under * (255 - alpha) + over * alpha)
+
+
+class ThumbnailTemplate:
+    # A product color asset with its print area resolved once. Everything
+    # outside the print area does not depend on the pattern, so the finished
+    # thumbnail (cloth over the empty canvas, flattened on white) is kept and
+    # each render only blends the pattern rectangle.
+    def __init__(self, cloth_bytes, dimensions):
+        dim_left, dim_top, dim_width, dim_height = dimensions
+        cloth = np.asarray(Image.open(BytesIO(cloth_bytes)).convert("RGBA"))
+        total_pixels = cloth.shape[0]
+        x = round(percentage_to_pixels(dim_left, total_pixels))
+        y = round(percentage_to_pixels(dim_top, total_pixels))
+        width = round(percentage_to_pixels(dim_width, total_pixels))
+        height = round(percentage_to_pixels(dim_height, total_pixels))
+        if x < 0 or y < 0 or x + width > total_pixels or y + height > total_pixels:
+            raise ValueError("Pattern image dimensions exceed canvas bounds")
+
+        # The preview resizes the pattern to (height, width) as (x, y) size; kept as is
+        self.pattern_size = (height, width)
+        self.rows = slice(y, min(y + width, total_pixels))
+        self.columns = slice(x, min(x + height, total_pixels))
+
+        # The canvas is square on the cloth height: a wider cloth is cropped by
+        # the paste, a narrower one leaves the rest of the canvas empty
+        padded = np.zeros((total_pixels, total_pixels, 4), dtype=np.uint32)
+        canvas_width = min(cloth.shape[1], total_pixels)
+        padded[:, :canvas_width] = cloth[:, :canvas_width]
+        self.cloth = padded[self.rows, self.columns].copy()
+
+        # Empty canvas is (255, 255, 255, 0); the cloth is pasted over it with its own alpha
+        canvas = np.zeros((total_pixels, total_pixels, 4), dtype=np.uint32)
+        canvas[..., :3] = 255
+        canvas = _blend(canvas, padded, padded[..., 3:])
+        self.base = self._flatten(canvas)
+        self.base.setflags(write=False)
+
+    @staticmethod
+    def _flatten(rgba):
+        # Same as pasting onto a white RGB image with the alpha channel as mask
+        return _blend(np.uint32(255), rgba[..., :3], rgba[..., 3:]).astype(np.uint8)
+
+    def render(self, pattern_bytes):
+        # Finished RGB thumbnail for one pattern
+        pattern = Image.open(BytesIO(pattern_bytes)).convert("RGBA").resize(self.pattern_size)
+        pattern = np.asarray(pattern)[:self.rows.stop - self.rows.start, :self.columns.stop - self.columns.start]
+        pattern = pattern.astype(np.uint32)
+        alpha = pattern[..., 3:]
+
+        # Pattern over the empty canvas, then the cloth over that, then onto white
+        region = np.empty(pattern.shape, dtype=np.uint32)
+        region[..., :3] = _blend(np.uint32(255), pattern[..., :3], alpha)
+        region[..., 3:] = _div255(pattern[..., 3:] * alpha)
+        region = _blend(region, self.cloth, self.cloth[..., 3:])
+
+        image = self.base.copy()
+        image[self.rows, self.columns] = self._flatten(region)
+        return image
+
+    @property
+    def nbytes(self):
+        return self.base.nbytes + self.cloth.nbytes
+
+
+def encode_jpeg(image, quality=THUMBNAIL_JPEG_QUALITY):
+    buffered = BytesIO()
+    Image.fromarray(image).save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def get_template(template_key, cloth_bytes, dimensions):
+    # Decoded once per process; callers pass the asset bytes in case this one has not seen it
+    key = (template_key, tuple(dimensions))
+    with _templates_lock:
+        if key in _templates:
+            _templates.move_to_end(key)
+            return _templates[key]
+    template = ThumbnailTemplate(cloth_bytes, dimensions)
+    with _templates_lock:
+        _templates[key] = template
+        while len(_templates) > THUMBNAIL_TEMPLATE_CACHE:
+            _templates.popitem(last=False)
+    return template
+
+
+def render_thumbnail_batch(template_key, cloth_bytes, dimensions, patterns_bytes):
+    # Process pool entry point. Returns (jpeg_bytes, None) or (None, error) per pattern, in order
+    template = get_template(template_key, cloth_bytes, dimensions)
+    results = []
+    for pattern_bytes in patterns_bytes:
+        try:
+            results.append((encode_jpeg(template.render(pattern_bytes)), None))
+        except Exception as error:
+            results.append((None, f"Could not render thumbnail: {error}"))
+    return results
@@ -0,0 +1,225 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+import logging
+import asyncio
+import httpx
+import time
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+load_dotenv()
+
+VECTORIZER_URL = os.environ.get("VECTORIZER_URL", "https://vectorizer.ai/api/v1/vectorize")
+VECTORIZER_SECRET = os.environ.get("VECTORIZER_SECRET")
+VECTORIZER_TOKEN = os.environ.get("VECTORIZER_PRIVATE_TOKEN")
+VECTORIZER_TIMEOUT = float(os.environ.get("VECTORIZER_TIMEOUT", 60))
+VECTORIZER_RETRIES = int(os.environ.get("VECTORIZER_RETRIES", 3))
+
+# Concurrent vectorizer.ai requests adapt between these bounds: +1 per window
+# of successful calls, halved on 429/5xx (at most once per cooldown)
+VECTORIZER_MIN_CONCURRENCY = int(os.environ.get("VECTORIZER_MIN_CONCURRENCY", 1))
+VECTORIZER_MAX_CONCURRENCY = int(os.environ.get("VECTORIZER_MAX_CONCURRENCY", 32))
+VECTORIZER_INITIAL_CONCURRENCY = int(os.environ.get("VECTORIZER_INITIAL_CONCURRENCY", 4))
+VECTORIZER_BACKOFF_COOLDOWN = float(os.environ.get("VECTORIZER_BACKOFF_COOLDOWN", 2))
+
+OVERLOAD_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def retry_after_seconds(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class AIMDLimiter:
+    # Additive increase / multiplicative decrease concurrency limit. Callers
+    # wait in acquire() while the limit is reached or while a Retry-After
+    # pause is in effect.
+    def __init__(self, initial: int, minimum: int, maximum: int, cooldown: float):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.queued = 0
+        self.increases = 0
+        self.decreases = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            self.queued += 1
+            try:
+                while True:
+                    pause = self._paused_until - time.monotonic()
+                    if pause <= 0 and self.in_flight < int(self.limit):
+                        break
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), pause if pause > 0 else None)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        # Roughly +1 once a full window of requests has succeeded
+        if self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.increases += 1
+
+    def on_overload(self, retry_after=None):
+        now = time.monotonic()
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+        # Requests already in flight when the first 429 came back count as one signal
+        if now - self._last_decrease >= self.cooldown:
+            self.limit = max(float(self.minimum), self.limit / 2)
+            self._last_decrease = now
+            self.decreases += 1
+
+    def metrics(self):
+        return {
+            "limit": int(self.limit),
+            "min_limit": self.minimum,
+            "max_limit": self.maximum,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "paused_for_s": round(max(0.0, self._paused_until - time.monotonic()), 2),
+        }
+
+
+class VectorizerClient:
+    # One keep-alive client for every vectorizer.ai call, paced by an AIMD limiter
+    def __init__(self, limiter: AIMDLimiter, timeout: float, retries: int):
+        self.limiter = limiter
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self._client = None
+        self.requests = 0
+        self.succeeded = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.transport_errors = 0
+        self.failures = 0
+        self.retried = 0
+        self.request_seconds = 0.0
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.limiter.maximum,
+                    max_keepalive_connections=self.limiter.maximum,
+                ),
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 10.0)),
+                auth=(VECTORIZER_TOKEN, VECTORIZER_SECRET),
+            )
+        return self._client
+
+    async def vectorize(self, image_url, mode, output_format="eps"):
+        # Returns the vectorized file, or None when vectorizer.ai rejects the
+        # image. Raises httpx.RequestError once transport retries run out
+        data = {"mode": mode, "image.url": image_url, "output.file_format": output_format}
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            await self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = await self.client.post(VECTORIZER_URL, data=data)
+            except httpx.RequestError as error:
+                self.transport_errors += 1
+                self.limiter.on_overload()
+                logger.error(f"Vectorizer attempt {attempt + 1} failed: {error}")
+                if last_attempt:
+                    self.failures += 1
+                    raise
+                response = None
+            finally:
+                self.requests += 1
+                self.request_seconds += time.perf_counter() - start
+                await self.limiter.release()
+
+            if response is None:
+                self.retried += 1
+                await asyncio.sleep(0.5 * 2 ** attempt)
+                continue
+
+            if response.status_code == httpx.codes.OK:
+                self.succeeded += 1
+                self.limiter.on_success()
+                return response.content
+
+            if response.status_code in OVERLOAD_STATUS_CODES:
+                if response.status_code == 429:
+                    self.throttled += 1
+                else:
+                    self.server_errors += 1
+                retry_after = retry_after_seconds(response)
+                self.limiter.on_overload(retry_after)
+                if not last_attempt:
+                    logger.warning(f"Vectorizer returned {response.status_code}, retrying ({attempt + 1}/{self.retries})")
+                    self.retried += 1
+                    # With Retry-After the limiter holds every caller back instead
+                    if retry_after is None:
+                        await asyncio.sleep(0.5 * 2 ** attempt)
+                    continue
+
+            self.failures += 1
+            logger.error(f"Error: {response.status_code} {response.text}")
+            return None
+
+    def metrics(self):
+        return {
+            **self.limiter.metrics(),
+            "requests": self.requests,
+            "succeeded": self.succeeded,
+            "throttled": self.throttled,
+            "server_errors": self.server_errors,
+            "transport_errors": self.transport_errors,
+            "retried": self.retried,
+            "failures": self.failures,
+            "avg_request_ms": round(self.request_seconds * 1000 / self.requests, 2) if self.requests else None,
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+vectorizer_client = VectorizerClient(
+    AIMDLimiter(
+        VECTORIZER_INITIAL_CONCURRENCY,
+        VECTORIZER_MIN_CONCURRENCY,
+        VECTORIZER_MAX_CONCURRENCY,
+        VECTORIZER_BACKOFF_COOLDOWN,
+    ),
+    VECTORIZER_TIMEOUT,
+    VECTORIZER_RETRIES,
+)
+
+
+async def close_vectorizer_client():
+    await vectorizer_client.close()
@@ -0,0 +1,113 @@
+from database.OrganizationOperation import OrganizationOperation
+from database.PricesOperations import PricesOperations
+from utils.printful_util import get_products_and_variants_map
+from utils.mask_cache import mask_cache
+from db import get_database
+from datetime import datetime, timezone
+import logging
+import asyncio
+import time
+import os
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Fly stops idle machines, so the first request after a cold start would pay
+# for the org/price reads, the Printful catalog crawl and mask downloads.
+# With WARMUP_ENABLED those run in the background right after Mongo connects.
+# WARMUP_GATE_TIMEOUT > 0 makes requests wait (up to that many seconds) for it.
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "false").lower() in ("1", "true", "yes")
+WARMUP_GATE_TIMEOUT = float(os.environ.get("WARMUP_GATE_TIMEOUT", 0))
+
+warmup_state = {
+    "status": "disabled",
+    "started_at": None,
+    "finished_at": None,
+    "steps": {},
+}
+warmup_tasks = set()
+warmup_done = asyncio.Event()
+
+
+async def warm_prices(db):
+    prices, _ = await PricesOperations(db).get_with_etag()
+    return {"apparel": len(prices)}
+
+
+async def warm_organizations(db, mask_keys):
+    organizations = await OrganizationOperation(db).find_slim({})
+    for org in organizations:
+        for source in [org.get("greenmask")] + [product.get("greenmask") for product in org.get("products") or []]:
+            if source and source != "null" and source not in mask_keys:
+                mask_keys.append(source)
+    return {"organizations": len(organizations), "greenmasks": len(mask_keys)}
+
+
+async def warm_product_map():
+    product_map = await get_products_and_variants_map(refresh=True)
+    return {"products": len(product_map)}
+
+
+async def warm_masks(mask_keys):
+    mask_keys = mask_keys[:mask_cache.max_entries]
+    masks = await asyncio.gather(*[mask_cache.get(key) for key in mask_keys])
+    return {"masks": sum(1 for mask in masks if mask is not None), "requested": len(mask_keys)}
+
+
+async def run_step(name, coroutine):
+    start = time.perf_counter()
+    step = warmup_state["steps"][name] = {"status": "running"}
+    try:
+        result = await coroutine
+        step.update(status="ok", result=result)
+        return result
+    except Exception as e:
+        logger.error(f"Warm-up step {name} failed: {e}", exc_info=True)
+        step.update(status="failed", error=str(e))
+        return None
+    finally:
+        step["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+
+async def warm_caches():
+    warmup_state["status"] = "running"
+    warmup_state["started_at"] = datetime.now(timezone.utc).isoformat()
+    try:
+        db = get_database()
+        mask_keys = []
+        await asyncio.gather(
+            run_step("prices", warm_prices(db)),
+            run_step("organizations", warm_organizations(db, mask_keys)),
+            run_step("product_map", warm_product_map()),
+        )
+        await run_step("masks", warm_masks(mask_keys))
+    finally:
+        failed = any(step["status"] != "ok" for step in warmup_state["steps"].values())
+        warmup_state["status"] = "degraded" if failed else "ready"
+        warmup_state["finished_at"] = datetime.now(timezone.utc).isoformat()
+        warmup_done.set()
+        logger.info(f"Warm-up finished: {warmup_state['status']}")
+
+
+async def start_warmup():
+    if not WARMUP_ENABLED:
+        warmup_done.set()
+        return
+    warmup_state["status"] = "pending"
+    task = asyncio.create_task(warm_caches())
+    warmup_tasks.add(task)
+    task.add_done_callback(warmup_tasks.discard)
+
+
+def is_ready():
+    return warmup_state["status"] in ("disabled", "ready", "degraded")
+
+
+async def wait_until_ready(timeout: float):
+    if is_ready():
+        return True
+    try:
+        await asyncio.wait_for(warmup_done.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return is_ready()
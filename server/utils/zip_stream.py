@@ -0,0 +1,75 @@
+import zipfile
+import asyncio
+import time
+import os
+
+# Already compressed formats are stored as is; deflating them costs CPU for nothing
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".pdf", ".zip"}
+READ_CHUNK_BYTES = 1024 * 1024
+
+
+class _ChunkWriter:
+    # Write-only sink for zipfile. Without seek() zipfile writes data
+    # descriptors after each entry, so nothing is ever rewritten.
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+class ZipStream:
+    # A ZIP archive produced entry by entry: each add_file returns the bytes
+    # to send for that entry, close returns the central directory
+    def __init__(self):
+        self._writer = _ChunkWriter()
+        self._zip = zipfile.ZipFile(self._writer, "w")
+        self.entries = 0
+
+    def add_file(self, arcname, path):
+        extension = os.path.splitext(arcname)[1].lower()
+        info = zipfile.ZipInfo(arcname, time.localtime(os.path.getmtime(path))[:6])
+        info.compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+        # Lets zipfile decide on zip64 up front, it cannot go back to change it
+        info.file_size = os.path.getsize(path)
+        with open(path, "rb") as source, self._zip.open(info, "w") as entry:
+            while block := source.read(READ_CHUNK_BYTES):
+                entry.write(block)
+        self.entries += 1
+        return self._writer.take()
+
+    def close(self):
+        self._zip.close()
+        return self._writer.take()
+
+    @property
+    def size(self):
+        return self._writer.offset
+
+
+async def stream_zip(entries):
+    # entries is an async iterator of (arcname, path); yields the archive as
+    # each entry arrives, compressing off the event loop
+    archive = ZipStream()
+    try:
+        async for arcname, path in entries:
+            for chunk in await asyncio.to_thread(archive.add_file, arcname, path):
+                yield chunk
+        for chunk in archive.close():
+            yield chunk
+    finally:
+        if hasattr(entries, "aclose"):
+            await entries.aclose()